@@ -1,14 +1,17 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure
+from cachetools import TTLCache
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, field_validator
-from typing import List, Optional, Dict, Any, Union
+from typing import List, Optional, Dict, Any, Union, Callable, Awaitable
 import uuid
 from datetime import datetime, timezone, date, timedelta
 import jwt
@@ -17,6 +20,9 @@ from enum import Enum
 import base64
 import io
 import zipfile
+import itertools
+import tempfile
+import re
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import cm
@@ -34,7 +40,9 @@ client = AsyncIOMotorClient(
     serverSelectionTimeoutMS=30000,
     connectTimeoutMS=30000,
     socketTimeoutMS=30000,
-    maxPoolSize=10,
+    maxPoolSize=200,
+    minPoolSize=20,
+    waitQueueTimeoutMS=2000,
     retryWrites=True,
     retryReads=True
 )
@@ -48,7 +56,7 @@ JWT_EXPIRATION_HOURS = 24
 security = HTTPBearer()
 
 # Create the main app
-app = FastAPI(title="Ambulatorio Infermieristico API")
+app = FastAPI(title="Ambulatorio Infermieristico API", default_response_class=ORJSONResponse)
 
 # Health check endpoint for Kubernetes - MUST be at root level, not under /api
 @app.get("/health")
@@ -150,6 +158,14 @@ def generate_patient_code(nome: str, cognome: str) -> str:
     suffix = random.choice(string.ascii_lowercase)
     return f"{prefix}{digits}{suffix}"
 
+def patient_name_keys(cognome: Optional[str], nome: Optional[str]) -> dict:
+    """Cognome/nome in minuscolo, salvati sul paziente per le ricerche su indice"""
+    return {"cognome_lc": (cognome or "").lower(), "nome_lc": (nome or "").lower()}
+
+def prefix_range(value: str) -> dict:
+    """Condizione 'inizia con' utilizzabile dall'indice (alternativa a $regex ^...)"""
+    return {"$gte": value, "$lt": value + "\uffff"}
+
 class Patient(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -572,8 +588,16 @@ async def create_patient(data: PatientCreate, payload: dict = Depends(verify_tok
     patient_data["scheda_med_counter"] = 0
     patient = Patient(**patient_data)
     doc = patient.model_dump()
-    await db.patients.insert_one(doc)
-    return patient
+    doc.update(patient_name_keys(doc["cognome"], doc["nome"]))
+    # Un'altra richiesta può prendere lo stesso codice tra il controllo e l'inserimento
+    for _ in range(5):
+        try:
+            await db.patients.insert_one(doc)
+            return patient
+        except DuplicateKeyError:
+            doc.pop("_id", None)
+            patient.codice_paziente = doc["codice_paziente"] = generate_patient_code(data.nome, data.cognome)
+    raise HTTPException(status_code=409, detail="Impossibile generare un codice paziente univoco, riprova")
 
 @api_router.get("/patients", response_model=List[Patient])
 async def get_patients(
@@ -592,10 +616,8 @@ async def get_patients(
     if tipo:
         query["tipo"] = tipo.value
     if search:
-        query["$or"] = [
-            {"nome": {"$regex": search, "$options": "i"}},
-            {"cognome": {"$regex": search, "$options": "i"}}
-        ]
+        pattern = re.compile(re.escape(search), re.IGNORECASE)
+        query["$or"] = [{"nome": pattern}, {"cognome": pattern}]
     
     patients = await db.patients.find(query, {"_id": 0}).sort("cognome", 1).to_list(1000)
     return patients
@@ -619,6 +641,11 @@ async def update_patient(patient_id: str, data: PatientUpdate, payload: dict = D
     
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    if "cognome" in update_data or "nome" in update_data:
+        update_data.update(patient_name_keys(
+            update_data.get("cognome", patient.get("cognome")),
+            update_data.get("nome", patient.get("nome"))
+        ))
     
     await db.patients.update_one({"id": patient_id}, {"$set": update_data})
     updated = await db.patients.find_one({"id": patient_id}, {"_id": 0})
@@ -642,10 +669,21 @@ async def delete_patient(patient_id: str, payload: dict = Depends(verify_token))
     await db.appointments.delete_many({"patient_id": patient_id})
     await db.prescrizioni.delete_many({"patient_id": patient_id})
     await db.photos.delete_many({"patient_id": patient_id})
+    invalidate_period_stats()
     
     return {"message": "Paziente e tutte le schede correlate eliminati"}
 
 # ============== BATCH PATIENT OPERATIONS ==============
+async def insert_many_unordered(collection, docs: list) -> dict:
+    """insert_many(ordered=False): restituisce {indice: errore} dei documenti rifiutati"""
+    if not docs:
+        return {}
+    try:
+        await collection.insert_many(docs, ordered=False)
+    except BulkWriteError as bwe:
+        return {err["index"]: err.get("errmsg", "") for err in bwe.details.get("writeErrors", [])}
+    return {}
+
 class BatchPatientCreate(BaseModel):
     patients: List[PatientCreate]
 
@@ -664,7 +702,8 @@ async def create_patients_batch(data: BatchPatientCreate, payload: dict = Depend
     """Create multiple patients at once"""
     created = []
     errors = []
-    impianti_created = 0
+    pending = []  # (paziente, documento, scheda impianto o None) da inserire
+    batch_codes = set()
     
     for patient_data in data.patients:
         try:
@@ -679,8 +718,9 @@ async def create_patients_batch(data: BatchPatientCreate, payload: dict = Depend
             
             # Generate unique patient code
             codice_paziente = generate_patient_code(patient_data.nome, patient_data.cognome)
-            while await db.patients.find_one({"codice_paziente": codice_paziente}):
+            while codice_paziente in batch_codes or await db.patients.find_one({"codice_paziente": codice_paziente}):
                 codice_paziente = generate_patient_code(patient_data.nome, patient_data.cognome)
+            batch_codes.add(codice_paziente)
             
             # Estrai i dati dell'impianto prima di creare il paziente
             tipo_impianto = patient_data.tipo_impianto
@@ -694,10 +734,10 @@ async def create_patients_batch(data: BatchPatientCreate, payload: dict = Depend
             patient_dict["scheda_med_counter"] = 0
             patient = Patient(**patient_dict)
             doc = patient.model_dump()
-            await db.patients.insert_one(doc)
-            created.append(patient)
+            doc.update(patient_name_keys(doc["cognome"], doc["nome"]))
             
             # Se è un paziente PICC e ha dati dell'impianto, crea la scheda impianto
+            scheda_impianto = None
             if (patient_data.tipo in [PatientType.PICC, PatientType.PICC_MED] 
                 and tipo_impianto and data_inserimento_impianto):
                 scheda_impianto = {
@@ -717,12 +757,26 @@ async def create_patients_batch(data: BatchPatientCreate, payload: dict = Depend
                     "allegati": [],
                     "created_at": datetime.now(timezone.utc).isoformat()
                 }
-                await db.schede_impianto_picc.insert_one(scheda_impianto)
-                impianti_created += 1
+            pending.append((patient, doc, scheda_impianto))
                 
         except Exception as e:
             errors.append({"patient": f"{patient_data.cognome} {patient_data.nome}", "error": str(e)})
     
+    # Un solo insert_many per collezione; ordered=False: un documento rifiutato non blocca gli altri
+    failed = await insert_many_unordered(db.patients, [doc for _, doc, _ in pending])
+    schede = []
+    for i, (patient, doc, scheda_impianto) in enumerate(pending):
+        if i in failed:
+            errors.append({"patient": f"{patient.cognome} {patient.nome}", "error": failed[i]})
+            continue
+        created.append(patient)
+        if scheda_impianto:
+            schede.append(scheda_impianto)
+    
+    impianti_created = len(schede) - len(await insert_many_unordered(db.schede_impianto_picc, schede))
+    if schede:
+        invalidate_period_stats()
+    
     return {
         "created": len(created),
         "errors": len(errors),
@@ -802,6 +856,8 @@ async def delete_patients_batch(data: BatchDelete, payload: dict = Depends(verif
         except Exception as e:
             errors.append({"patient_id": patient_id, "error": str(e)})
     
+    invalidate_period_stats()
+    
     return {
         "deleted": len(deleted),
         "errors": len(errors),
@@ -818,6 +874,7 @@ async def create_implants_batch(data: BatchImplantCreate, payload: dict = Depend
     """Create multiple implants for existing PICC patients"""
     created = []
     errors = []
+    pending = []  # (scheda impianto, riepilogo per la risposta)
     
     for implant_data in data.implants:
         try:
@@ -861,18 +918,26 @@ async def create_implants_batch(data: BatchImplantCreate, payload: dict = Depend
                 "allegati": [],
                 "created_at": datetime.now(timezone.utc).isoformat()
             }
-            await db.schede_impianto_picc.insert_one(scheda_impianto)
-            created.append({
+            pending.append((scheda_impianto, {
                 "id": scheda_impianto["id"],
                 "patient_id": patient_id,
                 "patient_name": f"{patient.get('cognome')} {patient.get('nome')}",
                 "tipo_impianto": tipo_impianto,
                 "data_inserimento": data_inserimento
-            })
+            }))
             
         except Exception as e:
             errors.append({"patient_id": implant_data.get("patient_id"), "error": str(e)})
     
+    failed = await insert_many_unordered(db.schede_impianto_picc, [scheda for scheda, _ in pending])
+    for i, (scheda, summary) in enumerate(pending):
+        if i in failed:
+            errors.append({"patient_id": scheda["patient_id"], "error": failed[i]})
+        else:
+            created.append(summary)
+    if created:
+        invalidate_period_stats()
+    
     return {
         "created": len(created),
         "errors": len(errors),
@@ -897,33 +962,55 @@ async def search_picc_patients(q: str = "", ambulatorio: str = "", payload: dict
         query["ambulatorio"] = {"$in": payload["ambulatori"]}
     
     if q:
-        query["$or"] = [
-            {"nome": {"$regex": q, "$options": "i"}},
-            {"cognome": {"$regex": q, "$options": "i"}}
-        ]
+        pattern = re.compile(re.escape(q), re.IGNORECASE)
+        query["$or"] = [{"nome": pattern}, {"cognome": pattern}]
     
     patients = await db.patients.find(query, {"_id": 0, "id": 1, "nome": 1, "cognome": 1, "tipo": 1}).to_list(50)
     return patients
 
 # ============== APPOINTMENTS ROUTES ==============
+SLOT_CAPACITY = 2  # pazienti per slot (stesso tipo, stessa ora)
+
+def first_free_seq(used: set) -> int:
+    """Primo posto (seq) non ancora occupato nello slot"""
+    seq = 0
+    while seq in used:
+        seq += 1
+    return seq
+
+async def insert_appointment_in_slot(doc: dict, capacity: Optional[int] = SLOT_CAPACITY) -> bool:
+    """Inserisce l'appuntamento occupando un posto libero dello slot (seq 0..capacity-1).
+    L'indice unico parziale su (ambulatorio, data, tipo, ora, seq) impedisce a richieste
+    concorrenti di superare la capienza; restituisce False se lo slot è pieno.
+    Ogni appuntamento ha un seq (vedi backfill all'avvio), così tutti contano per la capienza;
+    con capacity=None (ripristini) il posto viene assegnato anche oltre la capienza."""
+    for seq in (range(capacity) if capacity is not None else itertools.count()):
+        try:
+            await db.appointments.insert_one({**doc, "seq": seq})
+            invalidate_period_stats()
+            return True
+        except DuplicateKeyError:
+            continue
+    return False
+
 @api_router.post("/appointments", response_model=Appointment)
 async def create_appointment(data: AppointmentCreate, payload: dict = Depends(verify_token)):
     if data.ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     # Get patient info
-    patient = await db.patients.find_one({"id": data.patient_id}, {"_id": 0})
+    patient = await db.patients.find_one({"id": data.patient_id}, {"_id": 0, "nome": 1, "cognome": 1})
     if not patient:
         raise HTTPException(status_code=404, detail="Paziente non trovato")
     
-    # Check slot availability (max 2 per type per slot)
+    # Check slot availability (max 2 per type per slot) - si ferma al secondo match
     existing = await db.appointments.count_documents({
         "ambulatorio": data.ambulatorio.value,
         "data": data.data,
         "ora": data.ora,
         "tipo": data.tipo
-    })
-    if existing >= 2:
+    }, limit=SLOT_CAPACITY)
+    if existing >= SLOT_CAPACITY:
         raise HTTPException(status_code=400, detail="Slot pieno (max 2 pazienti)")
     
     appointment = Appointment(
@@ -932,7 +1019,8 @@ async def create_appointment(data: AppointmentCreate, payload: dict = Depends(ve
         patient_cognome=patient["cognome"]
     )
     doc = appointment.model_dump()
-    await db.appointments.insert_one(doc)
+    if not await insert_appointment_in_slot(doc):
+        raise HTTPException(status_code=400, detail="Slot pieno (max 2 pazienti)")
     return appointment
 
 @api_router.get("/appointments", response_model=List[Appointment])
@@ -980,7 +1068,20 @@ async def update_appointment(appointment_id: str, data: dict, payload: dict = De
     if appointment["ambulatorio"] not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    await db.appointments.update_one({"id": appointment_id}, {"$set": data})
+    data.pop("seq", None)
+    if any(k in data and data[k] != appointment.get(k) for k in ("ambulatorio", "data", "tipo", "ora")):
+        # Spostato in un altro slot: occupa un posto libero del nuovo slot
+        for seq in range(SLOT_CAPACITY):
+            try:
+                await db.appointments.update_one({"id": appointment_id}, {"$set": {**data, "seq": seq}})
+                break
+            except DuplicateKeyError:
+                continue
+        else:
+            raise HTTPException(status_code=400, detail="Slot pieno (max 2 pazienti)")
+    else:
+        await db.appointments.update_one({"id": appointment_id}, {"$set": data})
+    invalidate_period_stats()
     updated = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
     return updated
 
@@ -993,6 +1094,7 @@ async def delete_appointment(appointment_id: str, payload: dict = Depends(verify
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     await db.appointments.delete_one({"id": appointment_id})
+    invalidate_period_stats()
     return {"message": "Appuntamento eliminato"}
 
 # ============== SLOT CHIUSI (CHIUDI AGENDA) ==============
@@ -1168,6 +1270,7 @@ async def create_scheda_impianto_picc(data: SchedaImpiantoPICCCreate, payload: d
     scheda = SchedaImpiantoPICC(**data.model_dump())
     doc = scheda.model_dump()
     await db.schede_impianto_picc.insert_one(doc)
+    invalidate_period_stats()
     return scheda
 
 @api_router.get("/schede-impianto-picc", response_model=List[SchedaImpiantoPICC])
@@ -1194,6 +1297,7 @@ async def update_scheda_impianto_picc(scheda_id: str, data: dict, payload: dict
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     await db.schede_impianto_picc.update_one({"id": scheda_id}, {"$set": data})
+    invalidate_period_stats()
     updated = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
     return updated
 
@@ -1778,6 +1882,75 @@ async def get_documents(
     return docs
 
 # ============== STATISTICS ==============
+# Le statistiche scorrono il cursore a blocchi invece di caricare tutto con to_list
+STATS_BATCH_SIZE = 500
+
+# Cache dei conteggi per periodo del confronto statistiche: (ambulatorio, anno, mese, tipo) -> stats
+PERIOD_STATS_TTL = 120  # secondi
+_period_stats_cache = TTLCache(maxsize=512, ttl=PERIOD_STATS_TTL)
+
+def invalidate_period_stats():
+    """Svuota la cache dopo ogni scrittura su appuntamenti o schede impianto"""
+    _period_stats_cache.clear()
+
+async def aggregate_prestazioni(query: dict):
+    """Conteggi per prestazione e totali (accessi, pazienti unici) in una sola aggregazione $facet"""
+    facets = await db.appointments.aggregate([
+        {"$match": query},
+        {"$facet": {
+            "by_prest": [
+                {"$unwind": "$prestazioni"},
+                {"$group": {"_id": "$prestazioni", "n": {"$sum": 1}}},
+                {"$sort": {"_id": 1}}
+            ],
+            "totals": [
+                {"$group": {"_id": None, "accessi": {"$sum": 1}, "pazienti": {"$addToSet": "$patient_id"}}},
+                {"$project": {"accessi": 1, "pazienti_unici": {"$size": "$pazienti"}}}
+            ]
+        }}
+    ]).to_list(1)
+    prestazioni_count = {r["_id"]: r["n"] for r in facets[0]["by_prest"]}
+    totals = facets[0]["totals"][0] if facets[0]["totals"] else {"accessi": 0, "pazienti_unici": 0}
+    return prestazioni_count, totals
+
+async def get_period_stats(ambulatorio: str, anno: int, mese: Optional[int], tipo: Optional[str]) -> dict:
+    key = (ambulatorio, anno, mese, tipo)
+    cached = _period_stats_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    if mese:
+        start_date = f"{anno}-{mese:02d}-01"
+        end_date = f"{anno}-{mese + 1:02d}-01" if mese < 12 else f"{anno + 1}-01-01"
+    else:
+        start_date = f"{anno}-01-01"
+        end_date = f"{anno + 1}-01-01"
+    
+    query = {
+        "ambulatorio": ambulatorio,
+        "data": {"$gte": start_date, "$lt": end_date},
+        "stato": {"$ne": "non_presentato"}
+    }
+    if tipo and tipo not in ["tutti", "IMPIANTI"]:
+        query["tipo"] = tipo
+    
+    # Impianti
+    imp_query = {"ambulatorio": ambulatorio, "data_impianto": {"$gte": start_date, "$lt": end_date}}
+    
+    (prestazioni_count, totals), impianti = await asyncio.gather(
+        aggregate_prestazioni(query),
+        db.schede_impianto_picc.count_documents(imp_query),
+    )
+    
+    stats = {
+        "accessi": totals["accessi"],
+        "pazienti_unici": totals["pazienti_unici"],
+        "prestazioni": prestazioni_count,
+        "impianti": impianti
+    }
+    _period_stats_cache[key] = stats
+    return stats
+
 @api_router.get("/statistics")
 async def get_statistics(
     ambulatorio: Ambulatorio,
@@ -1813,25 +1986,27 @@ async def get_statistics(
     elif ambulatorio == Ambulatorio.VILLA_GINESTRE:
         query["tipo"] = "PICC"
     
-    appointments = await db.appointments.find(query, {"_id": 0}).to_list(10000)
-    
     # IMPORTANTE: Escludere i pazienti "non_presentato" dalle statistiche
     # Le prestazioni dei pazienti segnati in rosso (non presentati) non vengono contate
-    appointments_validi = [app for app in appointments if app.get("stato") != "non_presentato"]
+    query["stato"] = {"$ne": "non_presentato"}
     
     # Calculate statistics (solo appuntamenti effettuati o da_fare, escludendo non_presentato)
-    total_accessi = len(appointments_validi)
-    unique_patients = len(set(a["patient_id"] for a in appointments_validi))
-    
-    # Prestazioni count (solo per appuntamenti validi)
+    total_accessi = 0
+    patient_ids = set()
     prestazioni_count = {}
-    for app in appointments_validi:
+    monthly_stats = {}
+    cursor = db.appointments.find(
+        query, {"_id": 0, "patient_id": 1, "data": 1, "prestazioni": 1}
+    ).batch_size(STATS_BATCH_SIZE)
+    async for app in cursor:
+        total_accessi += 1
+        patient_ids.add(app["patient_id"])
+        
+        # Prestazioni count
         for prest in app.get("prestazioni", []):
             prestazioni_count[prest] = prestazioni_count.get(prest, 0) + 1
-    
-    # Monthly breakdown (solo per appuntamenti validi)
-    monthly_stats = {}
-    for app in appointments_validi:
+        
+        # Monthly breakdown
         month = app["data"][:7]  # YYYY-MM
         if month not in monthly_stats:
             monthly_stats[month] = {"accessi": 0, "pazienti": set(), "prestazioni": {}}
@@ -1840,6 +2015,8 @@ async def get_statistics(
         for prest in app.get("prestazioni", []):
             monthly_stats[month]["prestazioni"][prest] = monthly_stats[month]["prestazioni"].get(prest, 0) + 1
     
+    unique_patients = len(patient_ids)
+    
     # Convert sets to counts
     for month in monthly_stats:
         monthly_stats[month]["pazienti_unici"] = len(monthly_stats[month]["pazienti"])
@@ -1934,6 +2111,7 @@ async def delete_scheda_impianto(scheda_id: str, payload: dict = Depends(verify_
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     await db.schede_impianto_picc.delete_one({"id": scheda_id})
+    invalidate_period_stats()
     return {"message": "Scheda impianto eliminata"}
 
 @api_router.delete("/schede-gestione-picc/{scheda_id}")
@@ -1968,6 +2146,7 @@ async def update_scheda_impianto(scheda_id: str, data: dict, payload: dict = Dep
     
     data["updated_at"] = datetime.now(timezone.utc).isoformat()
     await db.schede_impianto_picc.update_one({"id": scheda_id}, {"$set": data})
+    invalidate_period_stats()
     updated = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
     return updated
 
@@ -2000,8 +2179,6 @@ async def get_implant_statistics(
         "data_impianto": {"$gte": start_date, "$lt": end_date}
     }
     
-    schede = await db.schede_impianto_picc.find(query, {"_id": 0}).to_list(1000)
-    
     # Get list of existing patient IDs
     existing_patients = await db.patients.distinct("id", {"ambulatorio": ambulatorio.value})
     existing_patient_ids = set(existing_patients)
@@ -2009,8 +2186,13 @@ async def get_implant_statistics(
     # Count by type - only for existing patients
     tipo_counts = {}
     monthly_breakdown = {}
+    totale_impianti = 0
     
-    for scheda in schede:
+    cursor = db.schede_impianto_picc.find(
+        query, {"_id": 0, "patient_id": 1, "tipo_catetere": 1, "data_impianto": 1}
+    ).batch_size(STATS_BATCH_SIZE)
+    async for scheda in cursor:
+        totale_impianti += 1
         # Skip if patient no longer exists
         patient_id = scheda.get("patient_id")
         if patient_id and patient_id not in existing_patient_ids:
@@ -2038,7 +2220,7 @@ async def get_implant_statistics(
     }
     
     return {
-        "totale_impianti": len(schede),
+        "totale_impianti": totale_impianti,
         "per_tipo": tipo_counts,
         "tipo_labels": tipo_labels,
         "dettaglio_mensile": monthly_breakdown
@@ -2075,8 +2257,6 @@ async def get_espianti_statistics(
         "prestazioni": {"$in": espianto_types}
     }
     
-    appointments = await db.appointments.find(query, {"_id": 0}).to_list(10000)
-    
     # Count by type
     tipo_counts = {
         "espianto_picc": 0,
@@ -2085,7 +2265,8 @@ async def get_espianti_statistics(
     }
     monthly_breakdown = {}
     
-    for apt in appointments:
+    cursor = db.appointments.find(query, {"_id": 0, "prestazioni": 1, "data": 1}).batch_size(STATS_BATCH_SIZE)
+    async for apt in cursor:
         prestazioni = apt.get("prestazioni", [])
         data = apt.get("data", "")
         month_key = data[:7] if data else ""
@@ -2117,11 +2298,53 @@ async def get_espianti_statistics(
 
 # ============== PATIENT FOLDER DOWNLOAD ==============
 
-def generate_patient_pdf_section(patient: dict, schede_med: list, schede_impianto: list, schede_gestione: list, section: str = "all") -> bytes:
+# Campi effettivamente usati da generate_patient_pdf_section (niente foto/allegati)
+PDF_SCHEDA_MED_FIELDS = {
+    "_id": 0, "data_compilazione": 1, "fondo": 1, "margini": 1, "cute_perilesionale": 1,
+    "essudato_quantita": 1, "essudato_tipo": 1, "medicazione": 1, "prossimo_cambio": 1, "firma": 1,
+}
+PDF_SCHEDA_IMPIANTO_FIELDS = {
+    "_id": 0, "scheda_type": 1, "data_posizionamento": 1, "data_impianto": 1,
+    "presidio_ospedaliero": 1, "unita_operativa": 1, "tipo_catetere": 1, "braccio": 1, "vena": 1,
+    "exit_site_cm": 1, "valutazione_sito": 1, "ecoguidato": 1, "igiene_mani": 1,
+    "precauzioni_barriera": 1, "disinfezione": 1, "sutureless_device": 1,
+    "medicazione_trasparente": 1, "medicazione_occlusiva": 1, "controllo_rx": 1, "controllo_ecg": 1,
+    "modalita": 1, "motivazione": 1, "operatore": 1, "note": 1,
+}
+PDF_SCHEDA_GESTIONE_FIELDS = {"_id": 0, "mese": 1, "giorni": 1, "note": 1}
+
+# Oltre questa soglia il file generato passa su disco; in download si invia a blocchi
+SPOOL_MAX_SIZE = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Documenti per batch dal cursore quando si leggono tutte le schede di un paziente
+SCHEDE_BATCH_SIZE = 200
+
+
+def file_download_response(f, media_type: str, filename: str) -> StreamingResponse:
+    """Invia un file temporaneo a blocchi e lo chiude a fine trasferimento"""
+    size = f.seek(0, io.SEEK_END)
+    f.seek(0)
+
+    # Generatore sincrono: Starlette lo itera nel threadpool, così le letture da disco
+    # (file oltre SPOOL_MAX_SIZE) non bloccano l'event loop
+    def iter_file():
+        try:
+            while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+        finally:
+            f.close()
+
+    return StreamingResponse(
+        iter_file(),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}", "Content-Length": str(size)}
+    )
+
+def generate_patient_pdf_section(patient: dict, schede_med: list, schede_impianto: list, schede_gestione: list, section: str = "all") -> tempfile.SpooledTemporaryFile:
     """Generate PDF for a specific section of the patient folder
     section: 'all', 'anagrafica', 'medicazione', 'impianto', 'gestione'
     """
-    buffer = io.BytesIO()
+    buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
     doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=2*cm, leftMargin=2*cm, topMargin=2*cm, bottomMargin=2*cm)
     
     styles = getSampleStyleSheet()
@@ -2379,8 +2602,7 @@ def generate_patient_pdf_section(patient: dict, schede_med: list, schede_impiant
                 story.append(Spacer(1, 15))
     
     doc.build(story)
-    buffer.seek(0)
-    return buffer.getvalue()
+    return buffer
 
 
 def generate_patient_pdf(patient: dict, schede_med: list, schede_impianto: list, schede_gestione: list, photos: list) -> bytes:
@@ -2658,9 +2880,9 @@ def generate_patient_pdf(patient: dict, schede_med: list, schede_impianto: list,
     return buffer.getvalue()
 
 
-def generate_patient_zip(patient: dict, schede_med: list, schede_impianto: list, schede_gestione: list, photos: list) -> bytes:
+def generate_patient_zip(patient: dict, schede_med: list, schede_impianto: list, schede_gestione: list, photos: list) -> tempfile.SpooledTemporaryFile:
     """Generate a ZIP with patient data - NO allegati, only PDF cartella clinica"""
-    buffer = io.BytesIO()
+    buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
     
     with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
         # Add PDF summary (NO allegati, NO foto MED)
@@ -2690,8 +2912,7 @@ def generate_patient_zip(patient: dict, schede_med: list, schede_impianto: list,
         
         # NOTE: NO allegati nel ZIP - si scaricano singolarmente
     
-    buffer.seek(0)
-    return buffer.getvalue()
+    return buffer
 
 
 @api_router.get("/patients/{patient_id}/download/pdf")
@@ -2711,26 +2932,29 @@ async def download_patient_pdf(patient_id: str, section: str = "all", payload: d
     schede_gestione = []
     
     if section in ["all", "medicazione"]:
-        schede_med = await db.schede_medicazione_med.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
+        schede_med = await db.schede_medicazione_med.find(
+            {"patient_id": patient_id}, PDF_SCHEDA_MED_FIELDS
+        ).batch_size(SCHEDE_BATCH_SIZE).to_list(None)
     
     if section in ["all", "impianto"]:
-        schede_impianto = await db.schede_impianto_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
+        # Nel PDF vanno solo le schede complete
+        schede_impianto = await db.schede_impianto_picc.find(
+            {"patient_id": patient_id, "scheda_type": "completa"}, PDF_SCHEDA_IMPIANTO_FIELDS
+        ).batch_size(SCHEDE_BATCH_SIZE).to_list(None)
     
     if section in ["all", "gestione"]:
-        schede_gestione = await db.schede_gestione_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
+        schede_gestione = await db.schede_gestione_picc.find(
+            {"patient_id": patient_id}, PDF_SCHEDA_GESTIONE_FIELDS
+        ).batch_size(SCHEDE_BATCH_SIZE).to_list(None)
     
     # Generate PDF with the appropriate section
-    pdf_data = generate_patient_pdf_section(patient, schede_med, schede_impianto, schede_gestione, section)
+    pdf_file = generate_patient_pdf_section(patient, schede_med, schede_impianto, schede_gestione, section)
     
     section_names = {"all": "completa", "anagrafica": "anagrafica", "medicazione": "medicazione", "impianto": "impianto", "gestione": "gestione_picc"}
     section_name = section_names.get(section, section)
     filename = f"cartella_{section_name}_{patient.get('cognome', 'paziente')}_{patient.get('nome', '')}.pdf"
     
-    return StreamingResponse(
-        io.BytesIO(pdf_data),
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
+    return file_download_response(pdf_file, "application/pdf", filename)
 
 
 @api_router.get("/patients/{patient_id}/download/zip")
@@ -2743,19 +2967,15 @@ async def download_patient_zip(patient_id: str, payload: dict = Depends(verify_t
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     # Fetch all related data - NO photos (allegati si scaricano separatamente)
-    schede_med = await db.schede_medicazione_med.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
-    schede_impianto = await db.schede_impianto_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
-    schede_gestione = await db.schede_gestione_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
+    schede_med = await db.schede_medicazione_med.find({"patient_id": patient_id}, {"_id": 0}).batch_size(SCHEDE_BATCH_SIZE).to_list(None)
+    schede_impianto = await db.schede_impianto_picc.find({"patient_id": patient_id}, {"_id": 0}).batch_size(SCHEDE_BATCH_SIZE).to_list(None)
+    schede_gestione = await db.schede_gestione_picc.find({"patient_id": patient_id}, {"_id": 0}).batch_size(SCHEDE_BATCH_SIZE).to_list(None)
     
-    zip_data = generate_patient_zip(patient, schede_med, schede_impianto, schede_gestione, [])
+    zip_file = generate_patient_zip(patient, schede_med, schede_impianto, schede_gestione, [])
     
     filename = f"cartella_{patient.get('cognome', 'paziente')}_{patient.get('nome', '')}.zip"
     
-    return StreamingResponse(
-        io.BytesIO(zip_data),
-        media_type="application/zip",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
+    return file_download_response(zip_file, "application/zip", filename)
 
 
 # ============== ROOT ==============
@@ -2780,27 +3000,19 @@ class Prescrizione(BaseModel):
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
+PRESCRIZIONE_FIELDS = {
+    "_id": 0, "id": 1, "patient_id": 1, "ambulatorio": 1, "data_inizio": 1,
+    "durata_mesi": 1, "created_at": 1, "updated_at": 1,
+}
+
 @api_router.get("/prescrizioni")
 async def get_prescrizioni(
     ambulatorio: Ambulatorio,
     current_user: dict = Depends(get_current_user)
 ):
     """Get all prescriptions for an ambulatorio"""
-    cursor = db.prescrizioni.find({"ambulatorio": ambulatorio})
-    prescrizioni = await cursor.to_list(length=1000)
-    result = []
-    for p in prescrizioni:
-        item = {
-            "id": p.get("id", str(p.get("_id", ""))),
-            "patient_id": p.get("patient_id"),
-            "ambulatorio": p.get("ambulatorio"),
-            "data_inizio": p.get("data_inizio"),
-            "durata_mesi": p.get("durata_mesi"),
-            "created_at": p.get("created_at"),
-            "updated_at": p.get("updated_at")
-        }
-        result.append(item)
-    return result
+    cursor = db.prescrizioni.find({"ambulatorio": ambulatorio}, PRESCRIZIONE_FIELDS)
+    return await cursor.to_list(length=1000)
 
 @api_router.post("/prescrizioni")
 async def create_or_update_prescrizione(
@@ -2855,8 +3067,12 @@ async def delete_prescrizione(
 
 # ============== AI ASSISTANT ==============
 from emergentintegrations.llm.chat import LlmChat, UserMessage
+from functools import lru_cache
+from collections import OrderedDict
+from contextvars import ContextVar
+import asyncio
 import json
-import re
+import orjson
 
 # AI Chat history storage in MongoDB
 class AIChatMessage(BaseModel):
@@ -2888,8 +3104,26 @@ class UndoAction(BaseModel):
     undo_data: dict  # Dati necessari per annullare l'azione
     timestamp: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
+# Le azioni annullabili scadono dopo una settimana (indice TTL su expire_at)
+UNDO_RETENTION = timedelta(days=7)
+
+_background_tasks = set()
+
+def run_in_background(coro):
+    """Avvia una coroutine senza attenderne il risultato (scritture non necessarie alla risposta)"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)  # riferimento forte finché il task non termina
+    task.add_done_callback(_background_task_done)
+    return task
+
+def _background_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Background task error: {task.exception()}")
+
 async def save_undo_action(user_id: str, ambulatorio: str, action_type: str, description: str, undo_data: dict):
     """Salva un'azione per poterla annullare successivamente"""
+    now = datetime.now(timezone.utc)
     action = {
         "id": str(uuid.uuid4()),
         "user_id": user_id,
@@ -2897,27 +3131,75 @@ async def save_undo_action(user_id: str, ambulatorio: str, action_type: str, des
         "action_type": action_type,
         "action_description": description,
         "undo_data": undo_data,
-        "timestamp": datetime.now(timezone.utc).isoformat()
+        "timestamp": now.isoformat(),
+        "expire_at": now + UNDO_RETENTION
     }
     await db.ai_undo_history.insert_one(action)
     
-    # Mantieni solo le ultime 10 azioni per utente/ambulatorio
-    actions = await db.ai_undo_history.find(
-        {"user_id": user_id, "ambulatorio": ambulatorio}
-    ).sort("timestamp", -1).to_list(100)
+    # Mantieni solo le ultime 10 azioni per utente/ambulatorio:
+    # legge il timestamp della decima più recente ed elimina quelle precedenti
+    owner = {"user_id": user_id, "ambulatorio": ambulatorio}
+    cutoff = await db.ai_undo_history.find(
+        owner, {"_id": 0, "timestamp": 1}
+    ).sort("timestamp", -1).skip(9).limit(1).to_list(1)
     
-    if len(actions) > 10:
-        # Elimina le azioni più vecchie oltre le 10
-        old_ids = [a["id"] for a in actions[10:]]
-        await db.ai_undo_history.delete_many({"id": {"$in": old_ids}})
+    if cutoff:
+        await db.ai_undo_history.delete_many({**owner, "timestamp": {"$lt": cutoff[0]["timestamp"]}})
     
     return action["id"]
 
+# Collezioni collegate al paziente salvate nel backup per l'undo: (collezione, chiave nel backup)
+PATIENT_BACKUP_COLLECTIONS = [
+    ("appointments", "appointments"),
+    ("schede_impianto_picc", "schede_impianto"),
+    ("schede_gestione_picc", "schede_gestione"),
+    ("schede_medicazione_med", "schede_med"),
+    ("prescrizioni", "prescrizioni"),
+]
+
+# Campi ricalcolabili esclusi dal backup: vengono ricostruiti al ripristino
+PATIENT_BACKUP_EXCLUDED = {
+    "patients": ("cognome_lc", "nome_lc"),
+    "appointments": ("seq", "patient_nome", "patient_cognome"),
+}
+
+def backup_projection(collection: str, prefix: str = "") -> dict:
+    return {f"{prefix}{field}": 0 for field in ("_id", *PATIENT_BACKUP_EXCLUDED.get(collection, ()))}
+
+async def build_patients_backup(patient_ids: list) -> dict:
+    """Legge pazienti e dati collegati in una sola aggregazione ($lookup) per l'undo: id -> backup"""
+    pipeline = [{"$match": {"id": {"$in": patient_ids}}}]
+    for collection, key in PATIENT_BACKUP_COLLECTIONS:
+        pipeline.append({"$lookup": {"from": collection, "localField": "id", "foreignField": "patient_id", "as": key}})
+    projection = backup_projection("patients")
+    for collection, key in PATIENT_BACKUP_COLLECTIONS:
+        projection.update(backup_projection(collection, f"{key}."))
+    pipeline.append({"$project": projection})
+    
+    backups = {}
+    async for patient_data in db.patients.aggregate(pipeline):
+        backup = {key: patient_data.pop(key, []) for _, key in PATIENT_BACKUP_COLLECTIONS}
+        backup["patient_data"] = patient_data
+        backups[patient_data["id"]] = backup
+    return backups
+
+async def build_patient_backup(patient_id: str) -> Optional[dict]:
+    return (await build_patients_backup([patient_id])).get(patient_id)
+
+async def delete_patients_data(patient_ids: list):
+    """Elimina i pazienti e tutti i dati collegati: un delete_many $in per collezione, in parallelo"""
+    related_query = {"patient_id": {"$in": patient_ids}}
+    await asyncio.gather(
+        *(db[collection].delete_many(related_query) for collection, _ in PATIENT_BACKUP_COLLECTIONS),
+        db.patients.delete_many({"id": {"$in": patient_ids}})
+    )
+    invalidate_period_stats()
+
 async def get_undo_actions(user_id: str, ambulatorio: str, limit: int = 10):
     """Ottiene le ultime azioni annullabili"""
     return await db.ai_undo_history.find(
         {"user_id": user_id, "ambulatorio": ambulatorio},
-        {"_id": 0}
+        {"_id": 0, "expire_at": 0}
     ).sort("timestamp", -1).to_list(limit)
 
 async def execute_undo(action: dict, ambulatorio: str) -> dict:
@@ -2942,9 +3224,14 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
             prescrizioni = undo_data.get("prescrizioni", [])
             
             if patient_data:
+                patient_data.update(patient_name_keys(patient_data.get("cognome"), patient_data.get("nome")))
                 await db.patients.insert_one(patient_data)
             for apt in appointments:
-                await db.appointments.insert_one(apt)
+                apt.pop("seq", None)  # il posto nello slot potrebbe essere stato riassegnato
+                if patient_data:
+                    apt.setdefault("patient_nome", patient_data.get("nome", ""))
+                    apt.setdefault("patient_cognome", patient_data.get("cognome", ""))
+                await insert_appointment_in_slot(apt, capacity=None)
             for s in schede_impianto:
                 await db.schede_impianto_picc.insert_one(s)
             for s in schede_gestione:
@@ -2983,7 +3270,8 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
             # Annulla eliminazione appuntamento = ricrea
             appointment_data = undo_data.get("appointment_data")
             if appointment_data:
-                await db.appointments.insert_one(appointment_data)
+                appointment_data.pop("seq", None)
+                await insert_appointment_in_slot(appointment_data, capacity=None)
             return {"success": True, "message": f"↩️ Annullato: Appuntamento ripristinato"}
         
         elif action_type == "create_scheda_impianto":
@@ -3052,10 +3340,15 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
             for backup in all_backup_data:
                 patient_data = backup.get("patient_data")
                 if patient_data:
+                    patient_data.update(patient_name_keys(patient_data.get("cognome"), patient_data.get("nome")))
                     await db.patients.insert_one(patient_data)
                     restored_count += 1
                 for apt in backup.get("appointments", []):
-                    await db.appointments.insert_one(apt)
+                    apt.pop("seq", None)  # il posto nello slot potrebbe essere stato riassegnato
+                    if patient_data:
+                        apt.setdefault("patient_nome", patient_data.get("nome", ""))
+                        apt.setdefault("patient_cognome", patient_data.get("cognome", ""))
+                    await insert_appointment_in_slot(apt, capacity=None)
                 for s in backup.get("schede_impianto", []):
                     await db.schede_impianto_picc.insert_one(s)
                 for s in backup.get("schede_gestione", []):
@@ -3071,6 +3364,9 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
     except Exception as e:
         logger.error(f"Undo error: {str(e)}")
         return {"success": False, "message": f"❌ Errore nell'annullamento: {str(e)}"}
+    finally:
+        # Quasi ogni annullamento tocca appuntamenti o impianti: invalida dopo le scritture
+        invalidate_period_stats()
 
 SYSTEM_PROMPT = """Sei un assistente IA dell'Ambulatorio Infermieristico. Il tuo compito è eseguire ESATTAMENTE le istruzioni dell'utente.
 
@@ -3107,6 +3403,7 @@ REGOLE:
 - Se un orario è occupato, CHIEDI all'utente quale altro orario preferisce
 - I tipi paziente sono: PICC, MED, PICC_MED
 - **RICERCA PAZIENTE**: Usa prima il COGNOME, poi il nome
+- Se il messaggio contiene "[Contesto: ... (id: ...)]" e l'utente si riferisce a quel paziente, aggiungi "patient_id" con quell'id nei params
 
 FORMATO RISPOSTA:
 Per azioni, rispondi SOLO con JSON: {"action": "...", "params": {...}, "message": "..."}}
@@ -3169,6 +3466,105 @@ ALTRI ESEMPI:
 
 Per domande generiche (es. "Ciao"), rispondi normalmente senza JSON."""
 
+@lru_cache(maxsize=2)
+def _prompt_for(day: str) -> str:
+    """System prompt con la data del giorno (cambia solo a mezzanotte)"""
+    return SYSTEM_PROMPT.replace("{today}", day)
+
+
+# Chat LLM riusate per sessione (LRU): evitano di ricreare client e connessione a ogni messaggio
+AI_CHATS_MAX = 512
+_ai_chats: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+def get_ai_chat(api_key: str, session_id: str, today: str):
+    """Restituisce (chat, lock, nuova) della sessione; la chat viene ricreata al cambio di giorno.
+    Una chat riusata conserva già la conversazione: `nuova` indica se va fornito il contesto"""
+    entry = _ai_chats.get(session_id)
+    if entry and entry[0] == today:
+        _ai_chats.move_to_end(session_id)
+        return entry[1], entry[2], False
+    
+    chat = LlmChat(
+        api_key=api_key,
+        session_id=session_id,
+        system_message=_prompt_for(today)
+    ).with_model("openai", "gpt-4o")
+    lock = entry[2] if entry else asyncio.Lock()
+    _ai_chats[session_id] = (today, chat, lock)
+    _ai_chats.move_to_end(session_id)
+    while len(_ai_chats) > AI_CHATS_MAX:
+        # Non rimuovere sessioni con una richiesta in corso: ne nascerebbe un secondo lock
+        oldest = next((sid for sid, e in _ai_chats.items() if sid != session_id and not e[2].locked()), None)
+        if oldest is None:
+            break
+        del _ai_chats[oldest]
+    return chat, lock, True
+
+def reset_ai_chat(session_id: str):
+    """Forza la ricreazione della chat (con la storia dal DB) alla prossima richiesta,
+    mantenendo il lock della sessione"""
+    entry = _ai_chats.get(session_id)
+    if entry:
+        _ai_chats[session_id] = (None, entry[1], entry[2])
+
+
+def _find_json_object(s: str, start: int = 0) -> Optional[tuple]:
+    """Posizione (inizio, fine) del primo oggetto {...} bilanciato da `start`.
+    Scansione lineare che tiene conto di stringhe ed escape (niente backtracking)."""
+    i = s.find("{", start)
+    if i == -1:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for j in range(i, len(s)):
+        c = s[j]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return i, j + 1
+    return None
+
+
+def _extract_json(s: str) -> Optional[dict]:
+    """Primo oggetto JSON valido nella risposta del modello (anche dentro ```json ... ```)"""
+    if "{" not in s:
+        return None
+    _, fence, tail = s.partition("```json")
+    if fence:
+        s = tail
+    start = 0
+    while (span := _find_json_object(s, start)) is not None:
+        try:
+            obj = orjson.loads(s[span[0]:span[1]])
+            if isinstance(obj, dict):
+                return obj
+        except orjson.JSONDecodeError:
+            pass
+        start = span[0] + 1
+    return None
+
+
+# Cache delle risposte senza azione: stessa domanda (nella stessa sessione e contesto) -> stessa risposta
+AI_RESPONSE_CACHE_TTL = 3600  # secondi
+_ai_response_cache = TTLCache(maxsize=2000, ttl=AI_RESPONSE_CACHE_TTL)
+
+def _normalize_message(text: str) -> str:
+    """Ignora maiuscole, spazi ripetuti e punteggiatura finale"""
+    return " ".join(text.casefold().split()).rstrip("?!. ")
+
 async def get_ai_response(message: str, session_id: str, ambulatorio: str, user_id: str) -> dict:
     """Get AI response using emergentintegrations"""
     try:
@@ -3176,14 +3572,15 @@ async def get_ai_response(message: str, session_id: str, ambulatorio: str, user_
         if not api_key:
             return {"response": "Errore: chiave API non configurata", "action": None}
         
-        # Get chat history from database
-        history = await db.ai_chat_history.find({
-            "session_id": session_id
-        }).sort("timestamp", 1).to_list(50)
+        # Get chat history from database (last 10 messages, newest first via index)
+        history = await db.ai_chat_history.find(
+            {"session_id": session_id},
+            {"_id": 0, "role": 1, "content": 1}
+        ).sort("timestamp", -1).to_list(10)
         
         # Build conversation context
         context_messages = []
-        for msg in history[-10:]:  # Last 10 messages
+        for msg in reversed(history):
             context_messages.append(f"{msg['role'].upper()}: {msg['content']}")
         
         context = "\n".join(context_messages)
@@ -3191,1316 +3588,1335 @@ async def get_ai_response(message: str, session_id: str, ambulatorio: str, user_
         
         # Format system prompt with today's date
         today = datetime.now().strftime("%Y-%m-%d")
-        formatted_prompt = SYSTEM_PROMPT.replace("{today}", today)
-        
-        # Initialize chat
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=session_id,
-            system_message=formatted_prompt
-        ).with_model("openai", "gpt-4o")
         
-        user_msg = UserMessage(text=full_message)
-        response = await chat.send_message(user_msg)
+        cache_key = (user_id, session_id, ambulatorio, today, _normalize_message(full_message))
+        cached = _ai_response_cache.get(cache_key)
+        if cached is not None:
+            # La chat in memoria non vede questo turno: al prossimo messaggio riparte dalla storia nel DB
+            reset_ai_chat(session_id)
+            return dict(cached)
         
-        # Parse response for actions
-        action = None
-        response_text = response
-        
-        # Check if response contains JSON action - improved regex for nested objects
-        # First try to find JSON block with code fence
-        code_block_match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', response, re.DOTALL)
-        if code_block_match:
-            try:
-                action = json.loads(code_block_match.group(1))
-                response_text = action.get("message", response)
-            except json.JSONDecodeError:
-                pass
+        chat, lock, is_new = get_ai_chat(api_key, session_id, today)
         
-        # If no code block, try to find raw JSON
-        if not action:
-            # Find JSON that starts with {"action" and contains nested params
-            json_match = re.search(r'(\{[^{}]*"action"[^{}]*"params"\s*:\s*\{[^{}]*\}[^{}]*\})', response, re.DOTALL)
-            if json_match:
-                try:
-                    action = json.loads(json_match.group(1))
-                    response_text = action.get("message", response)
-                except json.JSONDecodeError:
-                    pass
+        # La storia dal DB serve solo a una chat appena creata (riavvio, nuovo giorno, eviction):
+        # una chat riusata la ha già e ripeterla gonfierebbe il prompt a ogni turno
+        user_msg = UserMessage(text=full_message if is_new else message)
+        async with lock:
+            response = await chat.send_message(user_msg)
         
-        # If the entire response is a JSON
-        if not action and response.strip().startswith('{'):
-            try:
-                action = json.loads(response.strip())
-                response_text = action.get("message", response)
-            except json.JSONDecodeError:
-                pass
+        # Parse response for actions
+        action = _extract_json(response)
+        response_text = action.get("message", response) if action else response
         
-        return {"response": response_text, "action": action}
+        result = {"response": response_text, "action": action}
+        if action is None:
+            # Solo risposte informative: un'azione non va mai rieseguita dalla cache
+            _ai_response_cache[cache_key] = dict(result)
+        return result
         
     except Exception as e:
         logger.error(f"AI Error: {str(e)}")
         return {"response": f"Mi dispiace, ho avuto un problema: {str(e)}", "action": None}
 
-async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dict:
-    """Execute an action determined by AI - VERSIONE COMPLETA"""
-    action_type = action.get("action")
-    params = action.get("params", {})
-    
-    # Helper per trovare paziente
-    async def find_patient(patient_name: str):
-        """
-        Ricerca paziente migliorata con matching più preciso.
-        Priorità: match esatto cognome > match esatto nome > match parziale
-        """
-        name_lower = patient_name.lower().strip()
-        parts = [p.strip() for p in name_lower.split() if len(p.strip()) > 1]
-        
-        if not parts:
-            return None
-        
-        projection = {"_id": 0}  # Escludi sempre _id
-        
-        # 1. Prima prova match esatto su cognome (primo termine)
-        if len(parts) >= 1:
-            # Prova il primo termine come cognome esatto
-            exact_match = await db.patients.find_one({
-                "ambulatorio": ambulatorio,
-                "cognome": {"$regex": f"^{parts[0]}$", "$options": "i"}
-            }, projection)
-            if exact_match:
-                # Se c'è un secondo termine, verifica che corrisponda al nome
-                if len(parts) >= 2:
-                    nome_lower = exact_match.get("nome", "").lower()
-                    if parts[1] in nome_lower or nome_lower.startswith(parts[1]):
-                        return exact_match
-                else:
+# Costanti usate dalle azioni dell'assistente
+MESI = ("", "gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno",
+        "luglio", "agosto", "settembre", "ottobre", "novembre", "dicembre")
+
+TIPO_LABELS = {"PICC": "PICC", "MED": "MED", "PICC_MED": "PICC+MED"}
+STATO_LABELS = {"in_cura": "In cura", "sospeso": "Sospesi", "dimesso": "Dimessi"}
+TIPO_CATETERE_LABELS = {
+    "picc": "PICC",
+    "midline": "Midline",
+    "picc_port": "PICC Port",
+    "port_a_cath": "Port-a-cath",
+}
+PRESTAZIONI_LABELS = {
+    "medicazione_semplice": "Medicazione semplice",
+    "irrigazione_catetere": "Irrigazione catetere",
+    "fasciatura_semplice": "Fasciatura semplice",
+    "iniezione_terapeutica": "Iniezione terapeutica",
+    "catetere_vescicale": "Catetere vescicale"
+}
+
+SEZIONE_LABELS = {
+    "completa": "Cartella Completa",
+    "anagrafica": "Anagrafica",
+    "impianto": "Scheda Impianto",
+    "gestione_picc": "Gestione PICC",
+    "scheda_med": "Scheda Medicazione"
+}
+
+SLOTS_MATTINA = ("08:30", "09:00", "09:30", "10:00", "10:30", "11:00", "11:30", "12:00", "12:30", "13:00", "13:30")
+SLOTS_POMERIGGIO = ("15:00", "15:30", "16:00", "16:30", "17:00", "17:30")
+SLOTS_ALL = SLOTS_MATTINA + SLOTS_POMERIGGIO
+
+_UUID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+# Campi del paziente letti dalle azioni IA (il documento completo serve solo per i backup)
+AI_PATIENT_PROJECTION = {"_id": 0, "id": 1, "cognome": 1, "nome": 1, "tipo": 1, "status": 1, "data_dimissione": 1, "ambulatorio": 1}
+
+# Dati minimi del paziente restituiti per la memoria contestuale del frontend
+_PATIENT_INFO_FIELDS = ("id", "cognome", "nome", "tipo")
+
+def _patient_info(patient: dict) -> dict:
+    return {k: patient.get(k, "") for k in _PATIENT_INFO_FIELDS}
+
+# Helper per trovare paziente
+# Memo delle ricerche per la singola azione IA: lo stesso nome non viene cercato due volte
+_patient_cache: ContextVar[dict] = ContextVar("_patient_cache")
+
+async def find_patient(patient_name: str, ambulatorio: str):
+    patient_cache = _patient_cache.get({})
+    key = patient_name.lower().strip()
+    lookup = patient_cache.get(key)
+    if lookup is None:
+        if _UUID_RE.fullmatch(key):
+            # Id già noto (memoria contestuale frontend): lookup diretto
+            coro = db.patients.find_one({"id": key, "ambulatorio": ambulatorio}, AI_PATIENT_PROJECTION)
+        else:
+            coro = lookup_patient(key, ambulatorio)
+        # Nel memo va il task, non il risultato: ricerche concorrenti dello stesso nome lo condividono
+        lookup = patient_cache[key] = asyncio.ensure_future(coro)
+    return await lookup
+
+def _patient_matches_name(patient: dict, patient_name: str) -> bool:
+    """True se ogni parola del nome richiesto compare in cognome/nome del paziente"""
+    words = f"{patient.get('cognome', '')} {patient.get('nome', '')}".lower().split()
+    return all(part in words for part in patient_name.lower().split())
+
+async def find_patient_by_params(params: dict, ambulatorio: str):
+    """Paziente indicato dall'azione: l'id della memoria contestuale vale solo se
+    corrisponde al nome richiesto (l'utente può riferirsi a un altro paziente)"""
+    patient_name = params.get("patient_name", "")
+    patient_id = params.get("patient_id")
+    if patient_id:
+        patient = await find_patient(patient_id, ambulatorio)
+        if patient and _patient_matches_name(patient, patient_name):
+            return patient
+    return await find_patient(patient_name, ambulatorio)
+
+async def find_patients(names: list, ambulatorio: str) -> list:
+    """Cerca più pazienti in parallelo; restituisce le coppie (nome, paziente o None)"""
+    unique_names = list(dict.fromkeys(names))
+    found = dict(zip(unique_names, await asyncio.gather(*(find_patient(name, ambulatorio) for name in unique_names))))
+    # Nomi diversi che indicano lo stesso paziente condividono lo stesso dict,
+    # così gli aggiornamenti fatti dal chiamante valgono anche per i duplicati
+    by_id = {}
+    return [(name, by_id.setdefault(found[name]["id"], found[name]) if found[name] else None)
+            for name in names]
+
+def forget_patient(patient: dict):
+    """Rimuove dal memo un paziente eliminato"""
+    patient_cache = _patient_cache.get({})
+    for key, lookup in list(patient_cache.items()):
+        if lookup.done() and not lookup.exception() and (lookup.result() or {}).get("id") == patient["id"]:
+            del patient_cache[key]
+
+async def lookup_patient(name_lower: str, ambulatorio: str):
+    """
+    Ricerca paziente migliorata con matching più preciso.
+    Priorità: match esatto cognome > match esatto nome > match parziale
+    """
+    parts = [p.strip() for p in name_lower.split() if len(p.strip()) > 1]
+    
+    if not parts:
+        return None
+    
+    projection = AI_PATIENT_PROJECTION
+    
+    # 1. Prima prova match esatto su cognome (primo termine)
+    if len(parts) >= 1:
+        # Prova il primo termine come cognome esatto
+        exact_match = await db.patients.find_one({
+            "ambulatorio": ambulatorio,
+            "cognome_lc": parts[0]
+        }, projection)
+        if exact_match:
+            # Se c'è un secondo termine, verifica che corrisponda al nome
+            if len(parts) >= 2:
+                nome_lower = exact_match.get("nome", "").lower()
+                if parts[1] in nome_lower or nome_lower.startswith(parts[1]):
                     return exact_match
-        
-        # 2. Prova match esatto cognome + nome insieme
-        if len(parts) >= 2:
-            # Cognome esatto + nome che inizia con
-            exact_match = await db.patients.find_one({
-                "ambulatorio": ambulatorio,
-                "cognome": {"$regex": f"^{parts[0]}$", "$options": "i"},
-                "nome": {"$regex": f"^{parts[1]}", "$options": "i"}
-            }, projection)
-            if exact_match:
-                return exact_match
-            
-            # Prova invertito (nome cognome invece di cognome nome)
-            exact_match = await db.patients.find_one({
-                "ambulatorio": ambulatorio,
-                "cognome": {"$regex": f"^{parts[1]}$", "$options": "i"},
-                "nome": {"$regex": f"^{parts[0]}", "$options": "i"}
-            }, projection)
-            if exact_match:
+            else:
                 return exact_match
-        
-        # 3. Match parziale su cognome (per abbreviazioni)
-        partial_match = await db.patients.find_one({
+    
+    # 2. Prova match esatto cognome + nome insieme
+    if len(parts) >= 2:
+        # Cognome esatto + nome che inizia con
+        exact_match = await db.patients.find_one({
             "ambulatorio": ambulatorio,
-            "cognome": {"$regex": f"^{parts[0]}", "$options": "i"}
+            "cognome_lc": parts[0],
+            "nome_lc": prefix_range(parts[1])
         }, projection)
-        if partial_match:
-            return partial_match
-        
-        # 4. Ultima risorsa: cerca in tutti i campi ma con AND invece di OR
-        # Tutti i termini devono essere presenti nel cognome+nome combinato
-        pipeline = [
-            {"$match": {"ambulatorio": ambulatorio}},
-            {"$addFields": {
-                "full_name": {"$concat": [{"$toLower": "$cognome"}, " ", {"$toLower": "$nome"}]}
-            }},
-            {"$match": {
-                "$and": [{"full_name": {"$regex": part, "$options": "i"}} for part in parts]
-            }},
-            {"$project": {"_id": 0, "full_name": 0}},  # Escludi _id e campo temporaneo
-            {"$limit": 1}
-        ]
+        if exact_match:
+            return exact_match
         
-        results = await db.patients.aggregate(pipeline).to_list(1)
-        if results:
-            return results[0]
-        
-        return None
+        # Prova invertito (nome cognome invece di cognome nome)
+        exact_match = await db.patients.find_one({
+            "ambulatorio": ambulatorio,
+            "cognome_lc": parts[1],
+            "nome_lc": prefix_range(parts[0])
+        }, projection)
+        if exact_match:
+            return exact_match
     
-    # Helper per trovare primo slot disponibile
-    async def find_available_slot(data: str, tipo: str, turno: str = "primo_disponibile"):
-        slots_mattina = ["08:30", "09:00", "09:30", "10:00", "10:30", "11:00", "11:30", "12:00", "12:30", "13:00", "13:30"]
-        slots_pomeriggio = ["15:00", "15:30", "16:00", "16:30", "17:00", "17:30"]
-        
-        if turno == "mattina":
-            slots = slots_mattina
-        elif turno == "pomeriggio":
-            slots = slots_pomeriggio
-        else:
-            slots = slots_mattina + slots_pomeriggio
-        
-        for slot in slots:
-            count = await db.appointments.count_documents({
-                "ambulatorio": ambulatorio,
-                "data": data,
-                "ora": slot,
-                "tipo": tipo
-            })
-            if count < 2:
-                return slot
-        return None
+    # 3. Match parziale su cognome (per abbreviazioni)
+    partial_match = await db.patients.find_one({
+        "ambulatorio": ambulatorio,
+        "cognome_lc": prefix_range(parts[0])
+    }, projection)
+    if partial_match:
+        return partial_match
     
-    # Nomi mesi per messaggi
-    MESI = ["", "gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno", 
-            "luglio", "agosto", "settembre", "ottobre", "novembre", "dicembre"]
+    # 4. Ultima risorsa: cerca in tutti i campi ma con AND invece di OR
+    # Tutti i termini devono essere presenti nel cognome+nome combinato
+    pipeline = [
+        {"$match": {"ambulatorio": ambulatorio}},
+        {"$addFields": {
+            "full_name": {"$concat": ["$cognome_lc", " ", "$nome_lc"]}
+        }},
+        {"$match": {
+            "$and": [{"full_name": re.compile(re.escape(part))} for part in parts]
+        }},
+        {"$project": AI_PATIENT_PROJECTION},  # Esclude anche il campo temporaneo
+        {"$limit": 1}
+    ]
     
-    try:
-        # ==================== UNDO ACTION ====================
-        if action_type == "undo_action":
-            action_id = params.get("action_id")
-            
-            if action_id:
-                # Annulla azione specifica
-                undo_action_data = await db.ai_undo_history.find_one({"id": action_id, "user_id": user_id, "ambulatorio": ambulatorio})
-            else:
-                # Annulla ultima azione
-                undo_action_data = await db.ai_undo_history.find_one(
-                    {"user_id": user_id, "ambulatorio": ambulatorio},
-                    sort=[("timestamp", -1)]
-                )
-            
-            if not undo_action_data:
-                return {"success": False, "message": "❌ Nessuna azione da annullare"}
-            
-            # Esegui l'annullamento
-            result = await execute_undo(undo_action_data, ambulatorio)
-            
-            # Rimuovi l'azione dallo storico
-            if result.get("success"):
-                await db.ai_undo_history.delete_one({"id": undo_action_data["id"]})
-            
-            return result
-        
-        # ==================== LIST UNDO ACTIONS ====================
-        elif action_type == "list_undo_actions":
-            actions = await get_undo_actions(user_id, ambulatorio, 10)
-            
-            if not actions:
-                return {"success": True, "message": "📋 Nessuna azione annullabile disponibile.\n\nLe azioni vengono salvate quando crei, modifichi o elimini pazienti, appuntamenti e schede."}
-            
-            msg = "📋 **Ultime azioni annullabili:**\n\n"
-            for i, action in enumerate(actions, 1):
-                timestamp = datetime.fromisoformat(action["timestamp"].replace("Z", "+00:00"))
-                time_str = timestamp.strftime("%d/%m %H:%M")
-                msg += f"{i}. {action['action_description']} ({time_str})\n"
-            
-            msg += "\n💡 Scrivi **'annulla'** per annullare l'ultima azione, oppure **'annulla azione 3'** per annullare una specifica."
-            
-            return {"success": True, "actions": actions, "message": msg}
-        
-        # ==================== CREATE PATIENT ====================
-        elif action_type == "create_patient":
-            patient_data = {
-                "id": str(uuid.uuid4()),
-                "nome": params.get("nome", ""),
-                "cognome": params.get("cognome", ""),
-                "tipo": params.get("tipo", "PICC"),
-                "ambulatorio": ambulatorio,
-                "status": "in_cura",
-                "created_at": datetime.now(timezone.utc).isoformat(),
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
-            await db.patients.insert_one(patient_data)
-            
-            # Salva per undo
-            await save_undo_action(
-                user_id, ambulatorio, "create_patient",
-                f"Creato paziente {params.get('cognome')} {params.get('nome')}",
-                {"patient_id": patient_data["id"]}
-            )
-            
-            return {"success": True, "patient_id": patient_data["id"], 
-                    "message": f"✅ Paziente **{params.get('cognome')} {params.get('nome')}** creato con successo come {params.get('tipo', 'PICC')}!\n\n💡 Puoi annullare questa azione dicendo 'annulla'",
-                    "can_undo": True}
-        
-        # ==================== SEARCH PATIENT ====================
-        elif action_type == "search_patient":
-            query = params.get("query", "").strip()
-            
-            # Prova prima con find_patient che ha logica migliorata
-            patient = await find_patient(query)
-            if patient:
-                patient_info = {"id": patient["id"], "cognome": patient.get("cognome", ""), "nome": patient.get("nome", ""), "tipo": patient.get("tipo", "")}
-                return {"success": True, "patients": [patient], 
-                        "patient": patient_info,
-                        "action_type": "search_patient",
-                        "message": f"🔍 Trovato: **{patient['cognome']} {patient['nome']}** ({patient['tipo']})\n\n💡 Cosa vuoi fare con questo paziente?"}
-            
-            # Se non trova esatto, cerca parziale
-            query_lower = query.lower()
-            parts = [p.strip() for p in query_lower.split() if len(p.strip()) > 1]
-            
-            # Costruisci query che cerca tutte le parti
-            if parts:
-                or_conditions = []
-                for part in parts:
-                    or_conditions.append({"nome": {"$regex": part, "$options": "i"}})
-                    or_conditions.append({"cognome": {"$regex": part, "$options": "i"}})
-                
-                patients = await db.patients.find({
-                    "ambulatorio": ambulatorio,
-                    "$or": or_conditions
-                }, {"_id": 0}).to_list(10)
-            else:
-                patients = []
-            
-            if patients:
-                names = [f"• {p['cognome']} {p['nome']} ({p['tipo']})" for p in patients]
-                if len(patients) == 1:
-                    patient_info = {"id": patients[0]["id"], "cognome": patients[0].get("cognome", ""), "nome": patients[0].get("nome", ""), "tipo": patients[0].get("tipo", "")}
-                    return {"success": True, "patients": patients, 
-                            "patient": patient_info,
-                            "action_type": "search_patient",
-                            "message": f"🔍 Trovato: **{patients[0]['cognome']} {patients[0]['nome']}** ({patients[0]['tipo']})\n\n💡 Cosa vuoi fare con questo paziente?"}
-                return {"success": True, "patients": patients, 
-                        "message": f"🔍 Ho trovato {len(patients)} pazienti:\n" + "\n".join(names) + "\n\n💡 Specifica quale paziente ti interessa."}
-            return {"success": False, "message": f"❌ Nessun paziente trovato con '{query}'"}
+    results = await db.patients.aggregate(pipeline).to_list(1)
+    if results:
+        return results[0]
+    
+    return None
+
+# Helper per trovare primo slot disponibile
+async def find_available_slot(data: str, tipo: str, ambulatorio: str, turno: str = "primo_disponibile"):
+    if turno == "mattina":
+        slots = SLOTS_MATTINA
+    elif turno == "pomeriggio":
+        slots = SLOTS_POMERIGGIO
+    else:
+        slots = SLOTS_ALL
+    
+    # Occupazione dei soli slot candidati in una sola query, poi scelta dello slot in Python
+    cursor = db.appointments.aggregate([
+        {"$match": {"ambulatorio": ambulatorio, "data": data, "tipo": tipo, "ora": {"$in": list(slots)}}},
+        {"$group": {"_id": "$ora", "n": {"$sum": 1}}}
+    ])
+    counts = {r["_id"]: r["n"] async for r in cursor}
+    return next((slot for slot in slots if counts.get(slot, 0) < 2), None)
+
+# Istante dell'azione IA in corso: calcolato una volta in execute_ai_action e condiviso dagli handler
+_ai_now: ContextVar[datetime] = ContextVar("_ai_now")
+
+def ai_now() -> datetime:
+    return _ai_now.get(None) or datetime.now(timezone.utc)
+
+def ai_today() -> datetime:
+    """ai_now() nel fuso locale del server, per date e anni di default"""
+    return ai_now().astimezone()
+
+# Registro azioni IA: nome azione -> handler(params, ambulatorio, user_id)
+AI_ACTION_HANDLERS: Dict[str, Callable[[dict, str, str], Awaitable[dict]]] = {}
+
+def ai_handler(name: str):
+    def register(fn):
+        AI_ACTION_HANDLERS[name] = fn
+        return fn
+    return register
+
+# ==================== UNDO ACTION ====================
+@ai_handler("undo_action")
+async def _handle_undo_action(params: dict, ambulatorio: str, user_id: str) -> dict:
+    action_id = params.get("action_id")
+    
+    if action_id:
+        # Annulla azione specifica
+        undo_action_data = await db.ai_undo_history.find_one({"id": action_id, "user_id": user_id, "ambulatorio": ambulatorio})
+    else:
+        # Annulla ultima azione
+        undo_action_data = await db.ai_undo_history.find_one(
+            {"user_id": user_id, "ambulatorio": ambulatorio},
+            sort=[("timestamp", -1)]
+        )
+    
+    if not undo_action_data:
+        return {"success": False, "message": "❌ Nessuna azione da annullare"}
+    
+    # Esegui l'annullamento
+    result = await execute_undo(undo_action_data, ambulatorio)
+    
+    # Rimuovi l'azione dallo storico
+    if result.get("success"):
+        await db.ai_undo_history.delete_one({"id": undo_action_data["id"]})
+    
+    return result
+
+# ==================== LIST UNDO ACTIONS ====================
+@ai_handler("list_undo_actions")
+async def _handle_list_undo_actions(params: dict, ambulatorio: str, user_id: str) -> dict:
+    actions = await get_undo_actions(user_id, ambulatorio, 10)
+    
+    if not actions:
+        return {"success": True, "message": "📋 Nessuna azione annullabile disponibile.\n\nLe azioni vengono salvate quando crei, modifichi o elimini pazienti, appuntamenti e schede."}
+    
+    parts = ["📋 **Ultime azioni annullabili:**\n\n"]
+    for i, action in enumerate(actions, 1):
+        # save_undo_action salva isoformat() con offset esplicito: nessuna normalizzazione di "Z"
+        timestamp = action["timestamp"]
+        if not isinstance(timestamp, datetime):
+            timestamp = datetime.fromisoformat(timestamp)
+        time_str = timestamp.strftime("%d/%m %H:%M")
+        parts.append(f"{i}. {action['action_description']} ({time_str})\n")
+    
+    parts.append("\n💡 Scrivi **'annulla'** per annullare l'ultima azione, oppure **'annulla azione 3'** per annullare una specifica.")
+    msg = "".join(parts)
+    
+    return {"success": True, "actions": actions, "message": msg}
+
+# ==================== CREATE PATIENT ====================
+@ai_handler("create_patient")
+async def _handle_create_patient(params: dict, ambulatorio: str, user_id: str) -> dict:
+    now_iso = ai_now().isoformat()
+    patient_data = {
+        "id": str(uuid.uuid4()),
+        "nome": params.get("nome", ""),
+        "cognome": params.get("cognome", ""),
+        "tipo": params.get("tipo", "PICC"),
+        "ambulatorio": ambulatorio,
+        "status": "in_cura",
+        "created_at": now_iso,
+        "updated_at": now_iso
+    }
+    patient_data.update(patient_name_keys(patient_data["cognome"], patient_data["nome"]))
+    await db.patients.insert_one(patient_data)
+    
+    # Salva per undo
+    run_in_background(save_undo_action(
+        user_id, ambulatorio, "create_patient",
+        f"Creato paziente {params.get('cognome')} {params.get('nome')}",
+        {"patient_id": patient_data["id"]}
+    ))
+    
+    return {"success": True, "patient_id": patient_data["id"], 
+            "message": f"✅ Paziente **{params.get('cognome')} {params.get('nome')}** creato con successo come {params.get('tipo', 'PICC')}!\n\n💡 Puoi annullare questa azione dicendo 'annulla'",
+            "can_undo": True}
+
+# ==================== SEARCH PATIENT ====================
+@ai_handler("search_patient")
+async def _handle_search_patient(params: dict, ambulatorio: str, user_id: str) -> dict:
+    query = params.get("query", "").strip()
+    
+    # Prova prima con find_patient che ha logica migliorata
+    patient = await find_patient(query, ambulatorio)
+    if patient:
+        patient_info = _patient_info(patient)
+        return {"success": True, "patients": [patient], 
+                "patient": patient_info,
+                "action_type": "search_patient",
+                "message": f"🔍 Trovato: **{patient['cognome']} {patient['nome']}** ({patient['tipo']})\n\n💡 Cosa vuoi fare con questo paziente?"}
+    
+    # Se non trova esatto, cerca parziale
+    query_lower = query.lower()
+    parts = [p.strip() for p in query_lower.split() if len(p.strip()) > 1]
+    
+    # Cerca le parole con l'indice di testo, poi per prefisso su cognome/nome (entrambi su indice)
+    patients = []
+    if parts:
+        patients = await db.patients.find(
+            {"ambulatorio": ambulatorio, "$text": {"$search": " ".join(parts)}},
+            {"_id": 0, "id": 1, "cognome": 1, "nome": 1, "tipo": 1, "score": {"$meta": "textScore"}}
+        ).sort([("score", {"$meta": "textScore"})]).to_list(10)
+        for p in patients:
+            p.pop("score", None)
         
-        # ==================== CREATE APPOINTMENT ====================
-        elif action_type == "create_appointment":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato. Vuoi che lo crei?"}
-            
-            data = params.get("data")
-            ora = params.get("ora")  # L'orario ESATTO specificato dall'utente
-            turno = params.get("turno")
-            tipo = params.get("tipo", patient.get("tipo", "PICC"))
-            if tipo == "PICC_MED":
-                tipo = "PICC"
-            
-            # IMPORTANTE: Se l'utente ha specificato un orario, usalo SEMPRE
-            # Cerca slot solo se NON c'è un orario specificato
-            if not ora:
-                # Nessun orario specificato, cerca il primo disponibile
-                search_turno = turno if turno in ["mattina", "pomeriggio"] else "primo_disponibile"
-                ora = await find_available_slot(data, tipo, search_turno)
-                if not ora:
-                    turno_msg = f" del {turno}" if turno else ""
-                    return {"success": False, "message": f"❌ Nessun orario disponibile{turno_msg} per il {data}. Vuoi provare un altro giorno?"}
-            else:
-                # L'utente ha specificato un orario - verifica disponibilità
-                existing = await db.appointments.count_documents({
-                    "ambulatorio": ambulatorio,
-                    "data": data,
-                    "ora": ora,
-                    "tipo": tipo
-                })
-                
-                if existing >= 2:
-                    # Slot pieno - chiedi all'utente cosa fare
-                    return {"success": False, 
-                            "message": f"⚠️ Orario **{ora}** già occupato (2 pazienti).\n\nVuoi scegliere un altro orario?",
-                            "suggested_data": data}
-            
-            # Crea appuntamento
-            prestazioni = params.get("prestazioni", [])
-            if not prestazioni:
-                if tipo == "PICC":
-                    prestazioni = ["medicazione_semplice", "irrigazione_catetere"]
-                elif tipo == "MED":
-                    prestazioni = ["medicazione_semplice"]
+        if not patients:
+            or_conditions = [{f: prefix_range(part)} for part in parts for f in ("cognome_lc", "nome_lc")]
             
-            appointment = {
-                "id": str(uuid.uuid4()),
-                "patient_id": patient["id"],
-                "patient_nome": patient.get("nome", ""),
-                "patient_cognome": patient.get("cognome", ""),
+            patients = await db.patients.find({
                 "ambulatorio": ambulatorio,
-                "data": data,
-                "ora": ora,
-                "tipo": tipo,
-                "prestazioni": prestazioni,
-                "stato": "da_fare",
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-            await db.appointments.insert_one(appointment)
-            
-            # Salva per undo
-            await save_undo_action(
-                user_id, ambulatorio, "create_appointment",
-                f"Creato appuntamento per {patient['cognome']} {patient['nome']} il {data} alle {ora}",
-                {"appointment_id": appointment["id"]}
-            )
-            
-            # Includi info paziente per memoria contestuale frontend
-            patient_info = {"id": patient["id"], "cognome": patient.get("cognome", ""), "nome": patient.get("nome", ""), "tipo": patient.get("tipo", "")}
-            
-            return {"success": True, 
-                    "message": f"✅ Appuntamento creato!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📅 {data} alle **{ora}**\n🏷️ Tipo: {tipo}\n\n💡 Puoi annullare dicendo 'annulla'",
-                    "can_undo": True,
+                "$or": or_conditions
+            }, {"_id": 0, "id": 1, "cognome": 1, "nome": 1, "tipo": 1}).to_list(10)
+    
+    if patients:
+        names = [f"• {p['cognome']} {p['nome']} ({p['tipo']})" for p in patients]
+        if len(patients) == 1:
+            patient_info = _patient_info(patients[0])
+            return {"success": True, "patients": patients, 
                     "patient": patient_info,
-                    "action_type": "create_appointment"}
-        
-        # ==================== DELETE APPOINTMENT ====================
-        elif action_type == "delete_appointment":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-            
-            data = params.get("data")
-            ora = params.get("ora")
-            
-            query = {
-                "ambulatorio": ambulatorio,
-                "patient_id": patient["id"],
-                "data": data
-            }
-            if ora:
-                query["ora"] = ora
-            
-            # Trova l'appuntamento
-            appointment = await db.appointments.find_one(query)
-            if not appointment:
-                return {"success": False, "message": f"❌ Nessun appuntamento trovato per {patient['cognome']} {patient['nome']} il {data}"}
-            
-            # Salva per undo (copia i dati dell'appuntamento)
-            appointment_copy = {k: v for k, v in appointment.items() if k != "_id"}
-            await save_undo_action(
-                user_id, ambulatorio, "delete_appointment",
-                f"Eliminato appuntamento di {patient['cognome']} {patient['nome']} del {data}",
-                {"appointment_data": appointment_copy}
-            )
-            
-            # Elimina
-            await db.appointments.delete_one({"id": appointment["id"]})
-            return {"success": True, 
-                    "message": f"✅ Appuntamento eliminato!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📅 {data} alle {appointment.get('ora', 'N/A')}\n\n💡 Puoi annullare dicendo 'annulla'",
-                    "can_undo": True}
+                    "action_type": "search_patient",
+                    "message": f"🔍 Trovato: **{patients[0]['cognome']} {patients[0]['nome']}** ({patients[0]['tipo']})\n\n💡 Cosa vuoi fare con questo paziente?"}
+        return {"success": True, "patients": patients, 
+                "message": f"🔍 Ho trovato {len(patients)} pazienti:\n" + "\n".join(names) + "\n\n💡 Specifica quale paziente ti interessa."}
+    return {"success": False, "message": f"❌ Nessun paziente trovato con '{query}'"}
+
+# ==================== CREATE APPOINTMENT ====================
+@ai_handler("create_appointment")
+async def _handle_create_appointment(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato. Vuoi che lo crei?"}
+    
+    data = params.get("data")
+    ora = params.get("ora")  # L'orario ESATTO specificato dall'utente
+    turno = params.get("turno")
+    tipo = params.get("tipo", patient.get("tipo", "PICC"))
+    if tipo == "PICC_MED":
+        tipo = "PICC"
+    
+    # IMPORTANTE: Se l'utente ha specificato un orario, usalo SEMPRE
+    # Cerca slot solo se NON c'è un orario specificato
+    if not ora:
+        # Nessun orario specificato, cerca il primo disponibile
+        search_turno = turno if turno in ["mattina", "pomeriggio"] else "primo_disponibile"
+        ora = await find_available_slot(data, tipo, ambulatorio, search_turno)
+        if not ora:
+            turno_msg = f" del {turno}" if turno else ""
+            return {"success": False, "message": f"❌ Nessun orario disponibile{turno_msg} per il {data}. Vuoi provare un altro giorno?"}
+    else:
+        # L'utente ha specificato un orario - verifica disponibilità
+        existing = await db.appointments.count_documents({
+            "ambulatorio": ambulatorio,
+            "data": data,
+            "ora": ora,
+            "tipo": tipo
+        }, limit=SLOT_CAPACITY)
         
-        # ==================== GET PATIENTS COUNT ====================
-        elif action_type == "get_patients_count":
-            tipo = params.get("tipo", "tutti")
-            stato = params.get("stato", "tutti")
-            
-            query = {"ambulatorio": ambulatorio}
-            
-            # Filtra per tipo
-            if tipo and tipo != "tutti":
-                query["tipo"] = tipo
-            
-            # Filtra per stato
-            if stato and stato != "tutti":
-                query["status"] = stato
-            
-            # Conta pazienti
-            patients = await db.patients.find(query, {"_id": 0, "id": 1, "tipo": 1, "status": 1}).to_list(10000)
-            total = len(patients)
-            
-            # Conta per tipo
-            tipo_counts = {}
-            stato_counts = {}
-            for p in patients:
-                t = p.get("tipo", "non_specificato")
-                s = p.get("status", "in_cura")
-                tipo_counts[t] = tipo_counts.get(t, 0) + 1
-                stato_counts[s] = stato_counts.get(s, 0) + 1
-            
-            tipo_labels = {"PICC": "PICC", "MED": "MED", "PICC_MED": "PICC+MED"}
-            stato_labels = {"in_cura": "In cura", "sospeso": "Sospesi", "dimesso": "Dimessi"}
-            
-            msg = f"📊 **Conteggio Pazienti**\n\n"
-            msg += f"📈 **Totale: {total}** pazienti"
-            
-            if tipo != "tutti":
-                tipo_label = tipo_labels.get(tipo, tipo)
-                msg += f" di tipo {tipo_label}"
-            if stato != "tutti":
-                stato_label = stato_labels.get(stato, stato)
-                msg += f" ({stato_label})"
-            
-            msg += "\n\n"
-            
-            if tipo == "tutti":
-                msg += "**Per tipo:**\n"
-                for t, c in tipo_counts.items():
-                    label = tipo_labels.get(t, t)
-                    msg += f"🔹 {label}: {c}\n"
-                msg += "\n"
-            
-            if stato == "tutti":
-                msg += "**Per stato:**\n"
-                for s, c in stato_counts.items():
-                    label = stato_labels.get(s, s)
-                    msg += f"🔹 {label}: {c}\n"
-            
-            return {
-                "success": True, 
-                "totale": total, 
-                "per_tipo": tipo_counts,
-                "per_stato": stato_counts,
-                "message": msg
-            }
-        
-        # ==================== GET IMPLANT STATISTICS ====================
-        elif action_type == "get_implant_statistics":
-            tipo_impianto = params.get("tipo_impianto", "tutti")
-            anno = params.get("anno", datetime.now().year)
-            mese = params.get("mese")
-            generate_pdf = params.get("generate_pdf", False)
-            
-            # Build date range
-            if mese:
-                start_date = f"{anno}-{mese:02d}-01"
-                end_date = f"{anno}-{mese + 1:02d}-01" if mese < 12 else f"{anno + 1}-01-01"
-                periodo = f"{MESI[mese]} {anno}"
-            else:
-                start_date = f"{anno}-01-01"
-                end_date = f"{anno + 1}-01-01"
-                periodo = f"anno {anno}"
-            
-            query = {
-                "ambulatorio": ambulatorio,
-                "data_impianto": {"$gte": start_date, "$lt": end_date}
-            }
-            
-            if tipo_impianto and tipo_impianto != "tutti":
-                query["tipo_catetere"] = tipo_impianto
-            
-            schede = await db.schede_impianto_picc.find(query, {"_id": 0}).to_list(10000)
-            
-            # Conta per tipo
-            tipo_counts = {}
-            for s in schede:
-                t = s.get("tipo_catetere", "non_specificato")
-                tipo_counts[t] = tipo_counts.get(t, 0) + 1
-            
-            tipo_labels = {
-                "picc": "PICC",
-                "midline": "Midline", 
-                "picc_port": "PICC Port",
-                "port_a_cath": "Port-a-cath",
-            }
-            
-            if tipo_impianto and tipo_impianto != "tutti":
-                count = tipo_counts.get(tipo_impianto, 0)
-                label = tipo_labels.get(tipo_impianto, tipo_impianto.upper())
-                msg = f"📊 **Statistiche Impianti - {periodo}**\n\n"
-                msg += f"🔹 **{label}**: {count} impianti\n"
-            else:
-                msg = f"📊 **Statistiche Impianti - {periodo}**\n\n"
-                msg += f"📈 Totale: **{len(schede)}** impianti\n\n"
-                for t, c in tipo_counts.items():
-                    label = tipo_labels.get(t, t)
-                    msg += f"🔹 {label}: {c}\n"
-            
-            if generate_pdf:
-                msg += "\n\n📥 Clicca 'Scarica PDF' per il report."
-            else:
-                msg += "\n\nVuoi che generi il report PDF?"
-            
-            result = {"success": True, "totale": len(schede), "per_tipo": tipo_counts, 
-                    "periodo": periodo, "message": msg, "offer_pdf": True}
-            
-            if generate_pdf:
-                result["pdf_endpoint"] = f"/statistics/implants/pdf?ambulatorio={ambulatorio}&anno={anno}&mese={mese or ''}&tipo={tipo_impianto}"
-                result["filename"] = f"impianti_{periodo.replace(' ', '_')}.pdf"
-            
-            return result
-        
-        # ==================== GET PRESTAZIONI STATISTICS ====================
-        elif action_type == "get_prestazioni_statistics":
-            tipo = params.get("tipo")
-            anno = params.get("anno", datetime.now().year)
-            mese = params.get("mese")
-            generate_pdf = params.get("generate_pdf", False)
-            
-            if mese:
-                start_date = f"{anno}-{mese:02d}-01"
-                end_date = f"{anno}-{mese + 1:02d}-01" if mese < 12 else f"{anno + 1}-01-01"
-                periodo = f"{MESI[mese]} {anno}"
-            else:
-                start_date = f"{anno}-01-01"
-                end_date = f"{anno + 1}-01-01"
-                periodo = f"anno {anno}"
-            
-            query = {
-                "ambulatorio": ambulatorio,
-                "data": {"$gte": start_date, "$lt": end_date},
-                "stato": {"$ne": "non_presentato"}
-            }
-            if tipo and tipo != "tutti":
-                query["tipo"] = tipo
-            
-            appointments = await db.appointments.find(query).to_list(10000)
-            
-            prestazioni_count = {}
-            prestazioni_labels = {
-                "medicazione_semplice": "Medicazione semplice",
-                "irrigazione_catetere": "Irrigazione catetere",
-                "fasciatura_semplice": "Fasciatura semplice",
-                "iniezione_terapeutica": "Iniezione terapeutica",
-                "catetere_vescicale": "Catetere vescicale"
-            }
-            
-            for app in appointments:
-                for prest in app.get("prestazioni", []):
-                    prestazioni_count[prest] = prestazioni_count.get(prest, 0) + 1
-            
-            msg = f"📊 **Statistiche Prestazioni - {periodo}**\n\n"
-            msg += f"📈 Totale accessi: **{len(appointments)}**\n"
-            msg += f"👥 Pazienti unici: **{len(set(a['patient_id'] for a in appointments))}**\n\n"
-            
-            if prestazioni_count:
-                msg += "**Dettaglio prestazioni:**\n"
-                for p, c in prestazioni_count.items():
-                    label = prestazioni_labels.get(p, p)
-                    msg += f"🔹 {label}: {c}\n"
-            else:
-                msg += "Nessuna prestazione registrata.\n"
-            
-            if generate_pdf:
-                msg += "\n\n📥 Clicca 'Scarica PDF' per il report."
-            else:
-                msg += "\nVuoi che generi il report PDF?"
-            
-            result = {"success": True, "totale_accessi": len(appointments),
-                    "prestazioni": prestazioni_count, "periodo": periodo, 
-                    "message": msg, "offer_pdf": True}
-            
-            if generate_pdf:
-                result["pdf_endpoint"] = f"/statistics/pdf?ambulatorio={ambulatorio}&anno={anno}&mese={mese or ''}&tipo={tipo or 'tutti'}"
-                result["filename"] = f"prestazioni_{periodo.replace(' ', '_')}.pdf"
-            
-            return result
-        
-        # ==================== COPY SCHEDA MED ====================
-        elif action_type == "copy_scheda_med":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-            
-            # Trova ultima scheda MED
-            last_scheda = await db.schede_medicazione_med.find_one(
-                {"patient_id": patient["id"], "ambulatorio": ambulatorio},
-                sort=[("created_at", -1)]
-            )
-            
-            if not last_scheda:
-                return {"success": False, "message": f"❌ Nessuna scheda MED precedente trovata per {patient['cognome']} {patient['nome']}"}
-            
-            # Copia con nuova data
-            nuova_data = params.get("nuova_data", datetime.now().strftime("%Y-%m-%d"))
-            new_scheda = {k: v for k, v in last_scheda.items() if k not in ["_id", "id", "created_at", "updated_at"]}
-            new_scheda["id"] = str(uuid.uuid4())
-            new_scheda["data_compilazione"] = nuova_data
-            new_scheda["created_at"] = datetime.now(timezone.utc).isoformat()
-            new_scheda["updated_at"] = datetime.now(timezone.utc).isoformat()
-            
-            await db.schede_medicazione_med.insert_one(new_scheda)
-            
-            # Salva per undo
-            await save_undo_action(
-                user_id, ambulatorio, "copy_scheda_med",
-                f"Copiata scheda MED per {patient['cognome']} {patient['nome']}",
-                {"scheda_id": new_scheda["id"]}
-            )
-            
-            return {"success": True, 
-                    "message": f"✅ Scheda MED copiata!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📅 Nuova data: {nuova_data}\n\nHo copiato tutti i dati dalla scheda precedente.\n\n💡 Puoi annullare dicendo 'annulla'",
-                    "navigate_to": f"/pazienti/{patient['id']}",
-                    "can_undo": True}
-        
-        # ==================== COPY SCHEDA GESTIONE PICC ====================
-        elif action_type == "copy_scheda_gestione_picc":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-            
-            nuova_data = params.get("nuova_data", datetime.now().strftime("%Y-%m-%d"))
-            
-            # Trova ultima scheda gestione PICC
-            last_scheda = await db.schede_gestione_picc.find_one(
-                {"patient_id": patient["id"], "ambulatorio": ambulatorio},
-                sort=[("created_at", -1)]
-            )
-            
-            if not last_scheda:
-                return {"success": False, "message": f"❌ Nessuna scheda gestione PICC precedente trovata per {patient['cognome']} {patient['nome']}"}
-            
-            # Trova l'ultimo giorno compilato nella scheda
-            giorni = last_scheda.get("giorni", {})
-            if not giorni:
-                return {"success": False, "message": "❌ La scheda precedente non ha dati da copiare"}
-            
-            last_day_key = sorted(giorni.keys())[-1]
-            last_day_data = giorni[last_day_key]
-            
-            # Aggiorna la data nel nuovo giorno
-            day = int(nuova_data.split("-")[2])
-            month = int(nuova_data.split("-")[1])
-            new_day_data = {**last_day_data, "data_giorno_mese": f"{day}/{month}"}
-            
-            # Aggiungi il nuovo giorno alla scheda
-            await db.schede_gestione_picc.update_one(
-                {"id": last_scheda["id"]},
-                {"$set": {f"giorni.{nuova_data}": new_day_data, "updated_at": datetime.now(timezone.utc).isoformat()}}
-            )
-            
-            # Salva per undo
-            await save_undo_action(
-                user_id, ambulatorio, "copy_scheda_gestione_picc",
-                f"Copiata medicazione PICC per {patient['cognome']} {patient['nome']}",
-                {"scheda_id": last_scheda["id"], "day_key": nuova_data}
-            )
-            
-            # Includi info paziente per memoria contestuale frontend
-            patient_info = {"id": patient["id"], "cognome": patient.get("cognome", ""), "nome": patient.get("nome", ""), "tipo": patient.get("tipo", "")}
-            
-            return {"success": True,
-                    "message": f"✅ Medicazione PICC copiata!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📅 Nuova data: {nuova_data}\n\nHo copiato i dati dalla medicazione precedente ({last_day_key}).\n\n💡 Puoi annullare dicendo 'annulla'",
-                    "navigate_to": f"/pazienti/{patient['id']}",
-                    "can_undo": True,
-                    "patient": patient_info,
-                    "action_type": "copy_scheda_gestione_picc"}
-        
-        # ==================== OPEN PATIENT ====================
-        elif action_type == "open_patient":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if patient:
-                patient_info = {"id": patient["id"], "cognome": patient.get("cognome", ""), "nome": patient.get("nome", ""), "tipo": patient.get("tipo", "")}
-                return {"success": True, 
-                        "patient": patient_info, 
-                        "navigate_to": f"/pazienti/{patient['id']}",
-                        "message": f"📂 Apro la cartella di **{patient['cognome']} {patient['nome']}**...",
-                        "action_type": "open_patient"}
-            return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-        
-        # ==================== CREATE SCHEDA IMPIANTO ====================
-        elif action_type == "create_scheda_impianto":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-            
-            tipo_catetere = params.get("tipo_catetere", "picc")
-            data_impianto = params.get("data_impianto", datetime.now().strftime("%Y-%m-%d"))
-            
-            scheda = {
-                "id": str(uuid.uuid4()),
-                "patient_id": patient["id"],
-                "ambulatorio": ambulatorio,
-                "scheda_type": "semplificata",
-                "tipo_catetere": tipo_catetere,
-                "data_impianto": data_impianto,
-                "created_at": datetime.now(timezone.utc).isoformat(),
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
-            await db.schede_impianto_picc.insert_one(scheda)
-            
-            # Salva per undo
-            await save_undo_action(
-                user_id, ambulatorio, "create_scheda_impianto",
-                f"Creata scheda impianto per {patient['cognome']} {patient['nome']}",
-                {"scheda_id": scheda["id"]}
-            )
-            
-            tipo_labels = {"picc": "PICC", "midline": "Midline", "picc_port": "PICC Port", "port_a_cath": "Port-a-cath"}
-            label = tipo_labels.get(tipo_catetere, tipo_catetere.upper())
-            
-            return {"success": True, 
-                    "message": f"✅ Scheda impianto creata!\n\n👤 **{patient['cognome']} {patient['nome']}**\n🔹 Tipo: {label}\n📅 Data: {data_impianto}\n\n💡 Puoi annullare dicendo 'annulla'",
-                    "navigate_to": f"/pazienti/{patient['id']}",
-                    "can_undo": True}
-        
-        # ==================== GET STATISTICS (legacy) ====================
-        elif action_type == "get_statistics":
-            # Redirect to appropriate new action
-            tipo = params.get("tipo")
-            if tipo == "IMPIANTI":
-                params["tipo_impianto"] = "tutti"
-                return await execute_ai_action({"action": "get_implant_statistics", "params": params}, ambulatorio, user_id)
-            else:
-                return await execute_ai_action({"action": "get_prestazioni_statistics", "params": params}, ambulatorio, user_id)
-        
-        # ==================== SUSPEND PATIENT ====================
-        elif action_type == "suspend_patient":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-            
-            previous_status = patient.get("status", "in_cura")
-            
-            if previous_status == "sospeso":
-                return {"success": False, "message": f"⚠️ Il paziente **{patient['cognome']} {patient['nome']}** è già sospeso"}
-            
-            # Salva per undo
-            await save_undo_action(
-                user_id, ambulatorio, "suspend_patient",
-                f"Sospeso paziente {patient['cognome']} {patient['nome']}",
-                {"patient_id": patient["id"], "previous_status": previous_status}
-            )
-            
-            await db.patients.update_one(
-                {"id": patient["id"]},
-                {"$set": {"status": "sospeso", "updated_at": datetime.now(timezone.utc).isoformat()}}
-            )
-            
-            return {"success": True, 
-                    "message": f"✅ Paziente sospeso!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Stato: Sospeso\n\nIl paziente è stato temporaneamente sospeso.\n\n💡 Puoi annullare dicendo 'annulla'",
-                    "can_undo": True}
-        
-        # ==================== RESUME PATIENT ====================
-        elif action_type == "resume_patient":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-            
-            previous_status = patient.get("status", "sospeso")
-            
-            if previous_status == "in_cura":
-                return {"success": False, "message": f"⚠️ Il paziente **{patient['cognome']} {patient['nome']}** è già in cura"}
-            
-            # Salva per undo
-            await save_undo_action(
-                user_id, ambulatorio, "resume_patient",
-                f"Ripreso in cura paziente {patient['cognome']} {patient['nome']}",
-                {"patient_id": patient["id"], "previous_status": previous_status}
-            )
-            
-            await db.patients.update_one(
-                {"id": patient["id"]},
-                {"$set": {"status": "in_cura", "updated_at": datetime.now(timezone.utc).isoformat()}}
-            )
-            
-            return {"success": True, 
-                    "message": f"✅ Paziente ripreso in cura!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Stato: In cura\n\nIl paziente è stato ripreso in cura.\n\n💡 Puoi annullare dicendo 'annulla'",
-                    "can_undo": True}
-        
-        # ==================== DISCHARGE PATIENT ====================
-        elif action_type == "discharge_patient":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-            
-            previous_status = patient.get("status", "in_cura")
-            previous_data = {"data_dimissione": patient.get("data_dimissione")}
-            
-            if previous_status == "dimesso":
-                return {"success": False, "message": f"⚠️ Il paziente **{patient['cognome']} {patient['nome']}** è già dimesso"}
-            
-            # Salva per undo
-            await save_undo_action(
-                user_id, ambulatorio, "discharge_patient",
-                f"Dimesso paziente {patient['cognome']} {patient['nome']}",
-                {"patient_id": patient["id"], "previous_status": previous_status, "previous_data": previous_data}
-            )
-            
-            await db.patients.update_one(
-                {"id": patient["id"]},
-                {"$set": {"status": "dimesso", "data_dimissione": datetime.now().strftime("%Y-%m-%d"), "updated_at": datetime.now(timezone.utc).isoformat()}}
-            )
-            
-            return {"success": True, 
-                    "message": f"✅ Paziente dimesso!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Stato: Dimesso\n📅 Data dimissione: {datetime.now().strftime('%d/%m/%Y')}\n\nIl paziente è stato dimesso.\n\n💡 Puoi annullare dicendo 'annulla'",
-                    "can_undo": True}
-        
-        # ==================== DELETE PATIENT ====================
-        elif action_type == "delete_patient":
-            patient_name = params.get("patient_name", "")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-            
-            patient_id = patient["id"]
-            nome_completo = f"{patient['cognome']} {patient['nome']}"
-            
-            # Recupera tutti i dati correlati PRIMA di eliminarli (per undo)
-            patient_data = {k: v for k, v in patient.items() if k != "_id"}
-            appointments = await db.appointments.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
-            schede_impianto = await db.schede_impianto_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(100)
-            schede_gestione = await db.schede_gestione_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(100)
-            schede_med = await db.schede_medicazione_med.find({"patient_id": patient_id}, {"_id": 0}).to_list(100)
-            prescrizioni_list = await db.prescrizioni.find({"patient_id": patient_id}, {"_id": 0}).to_list(100)
-            
-            # Salva per undo
-            await save_undo_action(
-                user_id, ambulatorio, "delete_patient",
-                f"Eliminato paziente {nome_completo}",
-                {
-                    "patient_data": patient_data,
-                    "appointments": appointments,
-                    "schede_impianto": schede_impianto,
-                    "schede_gestione": schede_gestione,
-                    "schede_med": schede_med,
-                    "prescrizioni": prescrizioni_list
-                }
-            )
-            
-            # Delete all related data
-            await db.appointments.delete_many({"patient_id": patient_id})
-            await db.schede_impianto_picc.delete_many({"patient_id": patient_id})
-            await db.schede_gestione_picc.delete_many({"patient_id": patient_id})
-            await db.schede_medicazione_med.delete_many({"patient_id": patient_id})
-            await db.prescrizioni.delete_many({"patient_id": patient_id})
-            await db.patients.delete_one({"id": patient_id})
-            
-            return {"success": True, 
-                    "message": f"✅ Paziente eliminato definitivamente!\n\n👤 **{nome_completo}**\n\n⚠️ Tutti i dati del paziente sono stati eliminati.\n\n💡 **IMPORTANTE**: Puoi ancora annullare questa azione dicendo 'annulla'!",
-                    "can_undo": True}
+        if existing >= SLOT_CAPACITY:
+            # Slot pieno - chiedi all'utente cosa fare
+            return {"success": False, 
+                    "message": f"⚠️ Orario **{ora}** già occupato (2 pazienti).\n\nVuoi scegliere un altro orario?",
+                    "suggested_data": data}
+    
+    # Crea appuntamento
+    prestazioni = params.get("prestazioni", [])
+    if not prestazioni:
+        if tipo == "PICC":
+            prestazioni = ["medicazione_semplice", "irrigazione_catetere"]
+        elif tipo == "MED":
+            prestazioni = ["medicazione_semplice"]
+    
+    appointment = {
+        "id": str(uuid.uuid4()),
+        "patient_id": patient["id"],
+        "patient_nome": patient.get("nome", ""),
+        "patient_cognome": patient.get("cognome", ""),
+        "ambulatorio": ambulatorio,
+        "data": data,
+        "ora": ora,
+        "tipo": tipo,
+        "prestazioni": prestazioni,
+        "stato": "da_fare",
+        "created_at": ai_now().isoformat()
+    }
+    if not await insert_appointment_in_slot(appointment):
+        # Occupato nel frattempo da un'altra richiesta
+        return {"success": False,
+                "message": f"⚠️ Orario **{ora}** già occupato (2 pazienti).\n\nVuoi scegliere un altro orario?",
+                "suggested_data": data}
+    
+    # Salva per undo
+    run_in_background(save_undo_action(
+        user_id, ambulatorio, "create_appointment",
+        f"Creato appuntamento per {patient['cognome']} {patient['nome']} il {data} alle {ora}",
+        {"appointment_id": appointment["id"]}
+    ))
+    
+    # Includi info paziente per memoria contestuale frontend
+    patient_info = _patient_info(patient)
+    
+    return {"success": True, 
+            "message": f"✅ Appuntamento creato!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📅 {data} alle **{ora}**\n🏷️ Tipo: {tipo}\n\n💡 Puoi annullare dicendo 'annulla'",
+            "can_undo": True,
+            "patient": patient_info,
+            "action_type": "create_appointment"}
+
+# ==================== DELETE APPOINTMENT ====================
+@ai_handler("delete_appointment")
+async def _handle_delete_appointment(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    data = params.get("data")
+    ora = params.get("ora")
+    
+    query = {
+        "ambulatorio": ambulatorio,
+        "patient_id": patient["id"],
+        "data": data
+    }
+    if ora:
+        query["ora"] = ora
+    
+    # Trova l'appuntamento
+    appointment = await db.appointments.find_one(query)
+    if not appointment:
+        return {"success": False, "message": f"❌ Nessun appuntamento trovato per {patient['cognome']} {patient['nome']} il {data}"}
+    
+    # Salva per undo (copia i dati dell'appuntamento)
+    appointment_copy = {k: v for k, v in appointment.items() if k != "_id"}
+    run_in_background(save_undo_action(
+        user_id, ambulatorio, "delete_appointment",
+        f"Eliminato appuntamento di {patient['cognome']} {patient['nome']} del {data}",
+        {"appointment_data": appointment_copy}
+    ))
+    
+    # Elimina
+    await db.appointments.delete_one({"id": appointment["id"]})
+    invalidate_period_stats()
+    return {"success": True, 
+            "message": f"✅ Appuntamento eliminato!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📅 {data} alle {appointment.get('ora', 'N/A')}\n\n💡 Puoi annullare dicendo 'annulla'",
+            "can_undo": True}
+
+# ==================== GET PATIENTS COUNT ====================
+@ai_handler("get_patients_count")
+async def _handle_get_patients_count(params: dict, ambulatorio: str, user_id: str) -> dict:
+    tipo = params.get("tipo", "tutti")
+    stato = params.get("stato", "tutti")
+    
+    query = {"ambulatorio": ambulatorio}
+    
+    # Filtra per tipo
+    if tipo and tipo != "tutti":
+        query["tipo"] = tipo
+    
+    # Filtra per stato
+    if stato and stato != "tutti":
+        query["status"] = stato
+    
+    # Conta pazienti per (tipo, stato) direttamente in MongoDB
+    groups = await db.patients.aggregate([
+        {"$match": query},
+        {"$group": {
+            "_id": {
+                "tipo": {"$ifNull": ["$tipo", "non_specificato"]},
+                "stato": {"$ifNull": ["$status", "in_cura"]}
+            },
+            "n": {"$sum": 1}
+        }},
+        {"$sort": {"_id.tipo": 1, "_id.stato": 1}}
+    ]).to_list(None)
+    total = sum(g["n"] for g in groups)
+    
+    # Conta per tipo
+    tipo_counts = {}
+    stato_counts = {}
+    for g in groups:
+        t = g["_id"]["tipo"]
+        s = g["_id"]["stato"]
+        tipo_counts[t] = tipo_counts.get(t, 0) + g["n"]
+        stato_counts[s] = stato_counts.get(s, 0) + g["n"]
+    
+    totale_line = f"📈 **Totale: {total}** pazienti"
+    if tipo != "tutti":
+        totale_line += f" di tipo {TIPO_LABELS.get(tipo, tipo)}"
+    if stato != "tutti":
+        totale_line += f" ({STATO_LABELS.get(stato, stato)})"
+    
+    lines = ["📊 **Conteggio Pazienti**", "", totale_line, ""]
+    
+    if tipo == "tutti":
+        lines.append("**Per tipo:**")
+        lines.extend(f"🔹 {TIPO_LABELS.get(t, t)}: {c}" for t, c in tipo_counts.items())
+        lines.append("")
+    
+    if stato == "tutti":
+        lines.append("**Per stato:**")
+        lines.extend(f"🔹 {STATO_LABELS.get(s, s)}: {c}" for s, c in stato_counts.items())
+    
+    msg = "\n".join(lines)
+    
+    return {
+        "success": True, 
+        "totale": total, 
+        "per_tipo": tipo_counts,
+        "per_stato": stato_counts,
+        "message": msg
+    }
+
+# ==================== GET IMPLANT STATISTICS ====================
+@ai_handler("get_implant_statistics")
+async def _handle_get_implant_statistics(params: dict, ambulatorio: str, user_id: str) -> dict:
+    tipo_impianto = params.get("tipo_impianto", "tutti")
+    anno = params.get("anno", ai_today().year)
+    mese = params.get("mese")
+    generate_pdf = params.get("generate_pdf", False)
+    
+    # Build date range
+    if mese:
+        start_date = f"{anno}-{mese:02d}-01"
+        end_date = f"{anno}-{mese + 1:02d}-01" if mese < 12 else f"{anno + 1}-01-01"
+        periodo = f"{MESI[mese]} {anno}"
+    else:
+        start_date = f"{anno}-01-01"
+        end_date = f"{anno + 1}-01-01"
+        periodo = f"anno {anno}"
+    
+    query = {
+        "ambulatorio": ambulatorio,
+        "data_impianto": {"$gte": start_date, "$lt": end_date}
+    }
+    
+    if tipo_impianto and tipo_impianto != "tutti":
+        query["tipo_catetere"] = tipo_impianto
+    
+    # Conta per tipo direttamente in MongoDB
+    groups = await db.schede_impianto_picc.aggregate([
+        {"$match": query},
+        {"$group": {"_id": {"$ifNull": ["$tipo_catetere", "non_specificato"]}, "n": {"$sum": 1}}},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
+    tipo_counts = {g["_id"]: g["n"] for g in groups}
+    totale_impianti = sum(tipo_counts.values())
+    
+    lines = [f"📊 **Statistiche Impianti - {periodo}**", ""]
+    if tipo_impianto and tipo_impianto != "tutti":
+        count = tipo_counts.get(tipo_impianto, 0)
+        label = TIPO_CATETERE_LABELS.get(tipo_impianto, tipo_impianto.upper())
+        lines.append(f"🔹 **{label}**: {count} impianti")
+    else:
+        lines += [f"📈 Totale: **{totale_impianti}** impianti", ""]
+        lines.extend(f"🔹 {TIPO_CATETERE_LABELS.get(t, t)}: {c}" for t, c in tipo_counts.items())
+    
+    lines += ["", ""]
+    if generate_pdf:
+        lines.append("📥 Clicca 'Scarica PDF' per il report.")
+    else:
+        lines.append("Vuoi che generi il report PDF?")
+    msg = "\n".join(lines)
+    
+    result = {"success": True, "totale": totale_impianti, "per_tipo": tipo_counts, 
+            "periodo": periodo, "message": msg, "offer_pdf": True}
+    
+    if generate_pdf:
+        result["pdf_endpoint"] = f"/statistics/implants/pdf?ambulatorio={ambulatorio}&anno={anno}&mese={mese or ''}&tipo={tipo_impianto}"
+        result["filename"] = f"impianti_{periodo.replace(' ', '_')}.pdf"
+    
+    return result
+
+# ==================== GET PRESTAZIONI STATISTICS ====================
+@ai_handler("get_prestazioni_statistics")
+async def _handle_get_prestazioni_statistics(params: dict, ambulatorio: str, user_id: str) -> dict:
+    tipo = params.get("tipo")
+    anno = params.get("anno", ai_today().year)
+    mese = params.get("mese")
+    generate_pdf = params.get("generate_pdf", False)
+    
+    if mese:
+        start_date = f"{anno}-{mese:02d}-01"
+        end_date = f"{anno}-{mese + 1:02d}-01" if mese < 12 else f"{anno + 1}-01-01"
+        periodo = f"{MESI[mese]} {anno}"
+    else:
+        start_date = f"{anno}-01-01"
+        end_date = f"{anno + 1}-01-01"
+        periodo = f"anno {anno}"
+    
+    query = {
+        "ambulatorio": ambulatorio,
+        "data": {"$gte": start_date, "$lt": end_date},
+        "stato": {"$ne": "non_presentato"}
+    }
+    if tipo and tipo != "tutti":
+        query["tipo"] = tipo
+    
+    prestazioni_count, totals = await aggregate_prestazioni(query)
+    
+    lines = [
+        f"📊 **Statistiche Prestazioni - {periodo}**",
+        "",
+        f"📈 Totale accessi: **{totals['accessi']}**",
+        f"👥 Pazienti unici: **{totals['pazienti_unici']}**",
+        "",
+    ]
+    
+    if prestazioni_count:
+        lines.append("**Dettaglio prestazioni:**")
+        lines.extend(f"🔹 {PRESTAZIONI_LABELS.get(p, p)}: {c}" for p, c in prestazioni_count.items())
+    else:
+        lines.append("Nessuna prestazione registrata.")
+    
+    lines.append("")
+    if generate_pdf:
+        lines += ["", "📥 Clicca 'Scarica PDF' per il report."]
+    else:
+        lines.append("Vuoi che generi il report PDF?")
+    msg = "\n".join(lines)
+    
+    result = {"success": True, "totale_accessi": totals["accessi"],
+            "prestazioni": prestazioni_count, "periodo": periodo, 
+            "message": msg, "offer_pdf": True}
+    
+    if generate_pdf:
+        result["pdf_endpoint"] = f"/statistics/pdf?ambulatorio={ambulatorio}&anno={anno}&mese={mese or ''}&tipo={tipo or 'tutti'}"
+        result["filename"] = f"prestazioni_{periodo.replace(' ', '_')}.pdf"
+    
+    return result
+
+# ==================== COPY SCHEDA MED ====================
+@ai_handler("copy_scheda_med")
+async def _handle_copy_scheda_med(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    # Trova ultima scheda MED
+    last_scheda = await db.schede_medicazione_med.find_one(
+        {"patient_id": patient["id"], "ambulatorio": ambulatorio},
+        {"_id": 0, "id": 0, "created_at": 0, "updated_at": 0},
+        sort=[("created_at", -1)]
+    )
+    
+    if not last_scheda:
+        return {"success": False, "message": f"❌ Nessuna scheda MED precedente trovata per {patient['cognome']} {patient['nome']}"}
+    
+    # Copia con nuova data
+    nuova_data = params.get("nuova_data", ai_today().strftime("%Y-%m-%d"))
+    new_scheda = dict(last_scheda)
+    new_scheda["id"] = str(uuid.uuid4())
+    new_scheda["data_compilazione"] = nuova_data
+    now_iso = ai_now().isoformat()
+    new_scheda["created_at"] = now_iso
+    new_scheda["updated_at"] = now_iso
+    
+    await db.schede_medicazione_med.insert_one(new_scheda)
+    
+    # Salva per undo
+    run_in_background(save_undo_action(
+        user_id, ambulatorio, "copy_scheda_med",
+        f"Copiata scheda MED per {patient['cognome']} {patient['nome']}",
+        {"scheda_id": new_scheda["id"]}
+    ))
+    
+    return {"success": True, 
+            "message": f"✅ Scheda MED copiata!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📅 Nuova data: {nuova_data}\n\nHo copiato tutti i dati dalla scheda precedente.\n\n💡 Puoi annullare dicendo 'annulla'",
+            "navigate_to": f"/pazienti/{patient['id']}",
+            "can_undo": True}
+
+# ==================== COPY SCHEDA GESTIONE PICC ====================
+@ai_handler("copy_scheda_gestione_picc")
+async def _handle_copy_scheda_gestione_picc(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    nuova_data = params.get("nuova_data", ai_today().strftime("%Y-%m-%d"))
+    
+    # Trova ultima scheda gestione PICC
+    last_scheda = await db.schede_gestione_picc.find_one(
+        {"patient_id": patient["id"], "ambulatorio": ambulatorio},
+        {"_id": 0, "id": 1, "giorni": 1},
+        sort=[("created_at", -1)]
+    )
+    
+    if not last_scheda:
+        return {"success": False, "message": f"❌ Nessuna scheda gestione PICC precedente trovata per {patient['cognome']} {patient['nome']}"}
+    
+    # Trova l'ultimo giorno compilato nella scheda
+    giorni = last_scheda.get("giorni", {})
+    if not giorni:
+        return {"success": False, "message": "❌ La scheda precedente non ha dati da copiare"}
+    
+    last_day_key = max(giorni)
+    last_day_data = giorni[last_day_key]
+    
+    # Aggiorna la data nel nuovo giorno
+    _, month, day = nuova_data.split("-", 2)
+    new_day_data = {**last_day_data, "data_giorno_mese": f"{int(day)}/{int(month)}"}
+    
+    # Aggiungi il nuovo giorno alla scheda
+    await db.schede_gestione_picc.update_one(
+        {"id": last_scheda["id"]},
+        {"$set": {f"giorni.{nuova_data}": new_day_data, "updated_at": ai_now().isoformat()}}
+    )
+    
+    # Salva per undo
+    run_in_background(save_undo_action(
+        user_id, ambulatorio, "copy_scheda_gestione_picc",
+        f"Copiata medicazione PICC per {patient['cognome']} {patient['nome']}",
+        {"scheda_id": last_scheda["id"], "day_key": nuova_data}
+    ))
+    
+    # Includi info paziente per memoria contestuale frontend
+    patient_info = _patient_info(patient)
+    
+    return {"success": True,
+            "message": f"✅ Medicazione PICC copiata!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📅 Nuova data: {nuova_data}\n\nHo copiato i dati dalla medicazione precedente ({last_day_key}).\n\n💡 Puoi annullare dicendo 'annulla'",
+            "navigate_to": f"/pazienti/{patient['id']}",
+            "can_undo": True,
+            "patient": patient_info,
+            "action_type": "copy_scheda_gestione_picc"}
+
+# ==================== OPEN PATIENT ====================
+@ai_handler("open_patient")
+async def _handle_open_patient(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if patient:
+        patient_info = _patient_info(patient)
+        return {"success": True, 
+                "patient": patient_info, 
+                "navigate_to": f"/pazienti/{patient['id']}",
+                "message": f"📂 Apro la cartella di **{patient['cognome']} {patient['nome']}**...",
+                "action_type": "open_patient"}
+    return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+
+# ==================== CREATE SCHEDA IMPIANTO ====================
+@ai_handler("create_scheda_impianto")
+async def _handle_create_scheda_impianto(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    tipo_catetere = params.get("tipo_catetere", "picc")
+    data_impianto = params.get("data_impianto", ai_today().strftime("%Y-%m-%d"))
+    now_iso = ai_now().isoformat()
+    
+    scheda = {
+        "id": str(uuid.uuid4()),
+        "patient_id": patient["id"],
+        "ambulatorio": ambulatorio,
+        "scheda_type": "semplificata",
+        "tipo_catetere": tipo_catetere,
+        "data_impianto": data_impianto,
+        "created_at": now_iso,
+        "updated_at": now_iso
+    }
+    await db.schede_impianto_picc.insert_one(scheda)
+    invalidate_period_stats()
+    
+    # Salva per undo
+    run_in_background(save_undo_action(
+        user_id, ambulatorio, "create_scheda_impianto",
+        f"Creata scheda impianto per {patient['cognome']} {patient['nome']}",
+        {"scheda_id": scheda["id"]}
+    ))
+    
+    label = TIPO_CATETERE_LABELS.get(tipo_catetere, tipo_catetere.upper())
+    
+    return {"success": True, 
+            "message": f"✅ Scheda impianto creata!\n\n👤 **{patient['cognome']} {patient['nome']}**\n🔹 Tipo: {label}\n📅 Data: {data_impianto}\n\n💡 Puoi annullare dicendo 'annulla'",
+            "navigate_to": f"/pazienti/{patient['id']}",
+            "can_undo": True}
+
+# ==================== GET STATISTICS (legacy) ====================
+@ai_handler("get_statistics")
+async def _handle_get_statistics(params: dict, ambulatorio: str, user_id: str) -> dict:
+    # Reindirizza alle azioni statistiche attuali
+    tipo = params.get("tipo")
+    if tipo == "IMPIANTI":
+        params["tipo_impianto"] = "tutti"
+        return await _handle_get_implant_statistics(params, ambulatorio, user_id)
+    return await _handle_get_prestazioni_statistics(params, ambulatorio, user_id)
+
+# ==================== SUSPEND PATIENT ====================
+@ai_handler("suspend_patient")
+async def _handle_suspend_patient(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    # Controllo dello stato e aggiornamento in un'unica operazione: restituisce il documento precedente
+    before = await db.patients.find_one_and_update(
+        {"id": patient["id"], "status": {"$ne": "sospeso"}},
+        {"$set": {"status": "sospeso", "updated_at": ai_now().isoformat()}},
+        projection={"_id": 0, "status": 1}
+    )
+    if before is None:
+        return {"success": False, "message": f"⚠️ Il paziente **{patient['cognome']} {patient['nome']}** è già sospeso"}
+    previous_status = before.get("status", "in_cura")
+    patient["status"] = "sospeso"
+    
+    # Salva per undo
+    run_in_background(save_undo_action(
+        user_id, ambulatorio, "suspend_patient",
+        f"Sospeso paziente {patient['cognome']} {patient['nome']}",
+        {"patient_id": patient["id"], "previous_status": previous_status}
+    ))
+    
+    return {"success": True, 
+            "message": f"✅ Paziente sospeso!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Stato: Sospeso\n\nIl paziente è stato temporaneamente sospeso.\n\n💡 Puoi annullare dicendo 'annulla'",
+            "can_undo": True}
+
+# ==================== RESUME PATIENT ====================
+@ai_handler("resume_patient")
+async def _handle_resume_patient(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    before = await db.patients.find_one_and_update(
+        {"id": patient["id"], "status": {"$ne": "in_cura"}},
+        {"$set": {"status": "in_cura", "updated_at": ai_now().isoformat()}},
+        projection={"_id": 0, "status": 1}
+    )
+    if before is None:
+        return {"success": False, "message": f"⚠️ Il paziente **{patient['cognome']} {patient['nome']}** è già in cura"}
+    previous_status = before.get("status", "sospeso")
+    patient["status"] = "in_cura"
+    
+    # Salva per undo
+    run_in_background(save_undo_action(
+        user_id, ambulatorio, "resume_patient",
+        f"Ripreso in cura paziente {patient['cognome']} {patient['nome']}",
+        {"patient_id": patient["id"], "previous_status": previous_status}
+    ))
+    
+    return {"success": True, 
+            "message": f"✅ Paziente ripreso in cura!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Stato: In cura\n\nIl paziente è stato ripreso in cura.\n\n💡 Puoi annullare dicendo 'annulla'",
+            "can_undo": True}
+
+# ==================== DISCHARGE PATIENT ====================
+@ai_handler("discharge_patient")
+async def _handle_discharge_patient(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    before = await db.patients.find_one_and_update(
+        {"id": patient["id"], "status": {"$ne": "dimesso"}},
+        {"$set": {"status": "dimesso", "data_dimissione": ai_today().strftime("%Y-%m-%d"), "updated_at": ai_now().isoformat()}},
+        projection={"_id": 0, "status": 1, "data_dimissione": 1}
+    )
+    if before is None:
+        return {"success": False, "message": f"⚠️ Il paziente **{patient['cognome']} {patient['nome']}** è già dimesso"}
+    previous_status = before.get("status", "in_cura")
+    previous_data = {"data_dimissione": before.get("data_dimissione")}
+    patient["status"] = "dimesso"
+    
+    # Salva per undo
+    run_in_background(save_undo_action(
+        user_id, ambulatorio, "discharge_patient",
+        f"Dimesso paziente {patient['cognome']} {patient['nome']}",
+        {"patient_id": patient["id"], "previous_status": previous_status, "previous_data": previous_data}
+    ))
+    
+    return {"success": True, 
+            "message": f"✅ Paziente dimesso!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Stato: Dimesso\n📅 Data dimissione: {ai_today().strftime('%d/%m/%Y')}\n\nIl paziente è stato dimesso.\n\n💡 Puoi annullare dicendo 'annulla'",
+            "can_undo": True}
+
+# ==================== DELETE PATIENT ====================
+@ai_handler("delete_patient")
+async def _handle_delete_patient(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    patient_id = patient["id"]
+    nome_completo = f"{patient['cognome']} {patient['nome']}"
+    
+    # Recupera tutti i dati correlati PRIMA di eliminarli (per undo)
+    backup = await build_patient_backup(patient_id)
+    if not backup:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    # Salva per undo PRIMA di eliminare: il backup è l'unica copia dei dati
+    await save_undo_action(
+        user_id, ambulatorio, "delete_patient",
+        f"Eliminato paziente {nome_completo}",
+        backup
+    )
+    
+    # Delete all related data
+    await delete_patients_data([patient_id])
+    forget_patient(patient)
+    
+    return {"success": True, 
+            "message": f"✅ Paziente eliminato definitivamente!\n\n👤 **{nome_completo}**\n\n⚠️ Tutti i dati del paziente sono stati eliminati.\n\n💡 **IMPORTANTE**: Puoi ancora annullare questa azione dicendo 'annulla'!",
+            "can_undo": True}
+
+# ==================== COMPARE STATISTICS ====================
+@ai_handler("compare_statistics")
+async def _handle_compare_statistics(params: dict, ambulatorio: str, user_id: str) -> dict:
+    tipo = params.get("tipo", "tutti")
+    periodo1 = params.get("periodo1", {})
+    periodo2 = params.get("periodo2", {})
+    generate_pdf = params.get("generate_pdf", False)
+    
+    anno1 = periodo1.get("anno", ai_today().year - 1)
+    mese1 = periodo1.get("mese")
+    anno2 = periodo2.get("anno", ai_today().year)
+    mese2 = periodo2.get("mese")
+    
+    stats1 = await get_period_stats(ambulatorio, anno1, mese1, tipo)
+    stats2 = await get_period_stats(ambulatorio, anno2, mese2, tipo)
+    
+    periodo1_label = f"{MESI[mese1]} {anno1}" if mese1 else f"Anno {anno1}"
+    periodo2_label = f"{MESI[mese2]} {anno2}" if mese2 else f"Anno {anno2}"
+    
+    # Calculate differences
+    diff_accessi = stats2["accessi"] - stats1["accessi"]
+    diff_pazienti = stats2["pazienti_unici"] - stats1["pazienti_unici"]
+    diff_impianti = stats2["impianti"] - stats1["impianti"]
+    
+    def format_diff(val):
+        if val > 0:
+            return f"📈 +{val}"
+        elif val < 0:
+            return f"📉 {val}"
+        return "➡️ 0"
+    
+    msg = f"📊 **Confronto Statistiche**\n\n"
+    msg += f"**{periodo1_label}** vs **{periodo2_label}**\n\n"
+    msg += f"| Metrica | {periodo1_label} | {periodo2_label} | Diff |\n"
+    msg += f"|---------|---------|---------|------|\n"
+    msg += f"| Accessi | {stats1['accessi']} | {stats2['accessi']} | {format_diff(diff_accessi)} |\n"
+    msg += f"| Pazienti | {stats1['pazienti_unici']} | {stats2['pazienti_unici']} | {format_diff(diff_pazienti)} |\n"
+    msg += f"| Impianti | {stats1['impianti']} | {stats2['impianti']} | {format_diff(diff_impianti)} |\n"
+    
+    if generate_pdf:
+        msg += "\n\n📥 Clicca 'Scarica PDF' per il report completo."
+    
+    result = {
+        "success": True,
+        "message": msg,
+        "stats1": stats1,
+        "stats2": stats2,
+        "periodo1": periodo1_label,
+        "periodo2": periodo2_label
+    }
+    
+    if generate_pdf:
+        result["pdf_endpoint"] = f"/statistics/compare/pdf?ambulatorio={ambulatorio}&anno1={anno1}&mese1={mese1 or ''}&anno2={anno2}&mese2={mese2 or ''}&tipo={tipo}"
+        result["filename"] = f"confronto_{periodo1_label}_{periodo2_label}.pdf"
+    
+    return result
+
+# ==================== PRINT PATIENT FOLDER ====================
+@ai_handler("print_patient_folder")
+async def _handle_print_patient_folder(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_name = params.get("patient_name", "")
+    sezione = params.get("sezione", "completa")
+    patient = await find_patient_by_params(params, ambulatorio)
+    
+    if not patient:
+        return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
+    
+    label = SEZIONE_LABELS.get(sezione, sezione)
+    
+    return {
+        "success": True,
+        "message": f"📄 **PDF Pronto!**\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Sezione: {label}\n\nClicca 'Scarica PDF' per scaricare.",
+        "pdf_endpoint": f"/patients/{patient['id']}/export/pdf?sezione={sezione}",
+        "filename": f"{patient['cognome']}_{patient['nome']}_{sezione}.pdf"
+    }
+
+def batch_message(title: str, done: list, errors_title: str, errors: list, footer: str) -> str:
+    """Riepilogo delle azioni batch: elenco dei pazienti processati e degli errori"""
+    parts = [title, "\n\n"]
+    parts.extend(f"• {name}\n" for name in done)
+    if errors:
+        parts.append(errors_title)
+        parts.extend(f"• {err}\n" for err in errors)
+    parts.append(footer)
+    return "".join(parts)
+
+async def insert_ai_patients(patients_data: list, ambulatorio: str, tipo_default: str):
+    """Crea i pazienti con un solo insert_many; restituisce (creati, errori, id creati)"""
+    now_iso = ai_now().isoformat()
+    docs = []
+    for p in patients_data:
+        patient_data = {
+            "id": str(uuid.uuid4()),
+            "nome": p.get("nome", ""),
+            "cognome": p.get("cognome", ""),
+            "tipo": p.get("tipo", tipo_default),
+            "ambulatorio": ambulatorio,
+            "status": "in_cura",
+            "created_at": now_iso,
+            "updated_at": now_iso
+        }
+        patient_data.update(patient_name_keys(patient_data["cognome"], patient_data["nome"]))
+        docs.append(patient_data)
+    
+    failed = await insert_many_unordered(db.patients, docs)
+    
+    created = []
+    errors = []
+    patient_ids = []
+    for i, patient_data in enumerate(docs):
+        if i in failed:
+            errors.append(f"{patient_data['cognome']} {patient_data['nome']}: {failed[i]}")
+        else:
+            created.append(f"{patient_data['cognome']} {patient_data['nome']} ({patient_data['tipo']})")
+            patient_ids.append(patient_data["id"])
+    return created, errors, patient_ids
+
+# ==================== CREATE MULTIPLE PATIENTS (BATCH) ====================
+@ai_handler("create_multiple_patients")
+async def _handle_create_multiple_patients(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patients_data = params.get("patients", [])
+    
+    if not patients_data:
+        return {"success": False, "message": "❌ Nessun paziente da creare. Fornisci una lista di pazienti."}
+    
+    created, errors, patient_ids = await insert_ai_patients(patients_data, ambulatorio, "PICC")
+    
+    if created:
+        # Salva per undo
+        run_in_background(save_undo_action(
+            user_id, ambulatorio, "create_multiple_patients",
+            f"Creati {len(created)} pazienti",
+            {"patient_ids": patient_ids}
+        ))
+    
+    msg = batch_message(
+        f"✅ **Creati {len(created)} pazienti:**", created,
+        f"\n\n⚠️ **Errori ({len(errors)}):**\n", errors,
+        "\n💡 Puoi annullare dicendo 'annulla'"
+    )
+    
+    return {"success": True, "created": len(created), "errors": len(errors), "message": msg, "can_undo": True}
+
+# ==================== SUSPEND MULTIPLE PATIENTS (BATCH) ====================
+@ai_handler("suspend_multiple_patients")
+async def _handle_suspend_multiple_patients(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_names = params.get("patient_names", [])
+    
+    if not patient_names:
+        return {"success": False, "message": "❌ Nessun paziente specificato."}
+    
+    suspended = []
+    errors = []
+    undo_data = []
+    updates = []
+    now_iso = ai_now().isoformat()
+    
+    for name, patient in await find_patients(patient_names, ambulatorio):
+        if not patient:
+            errors.append(f"{name}: non trovato")
+            continue
         
-        # ==================== COMPARE STATISTICS ====================
-        elif action_type == "compare_statistics":
-            tipo = params.get("tipo", "tutti")
-            periodo1 = params.get("periodo1", {})
-            periodo2 = params.get("periodo2", {})
-            generate_pdf = params.get("generate_pdf", False)
-            
-            anno1 = periodo1.get("anno", datetime.now().year - 1)
-            mese1 = periodo1.get("mese")
-            anno2 = periodo2.get("anno", datetime.now().year)
-            mese2 = periodo2.get("mese")
-            
-            async def get_stats_for_period(anno, mese, tipo):
-                if mese:
-                    start_date = f"{anno}-{mese:02d}-01"
-                    end_date = f"{anno}-{mese + 1:02d}-01" if mese < 12 else f"{anno + 1}-01-01"
-                else:
-                    start_date = f"{anno}-01-01"
-                    end_date = f"{anno + 1}-01-01"
-                
-                query = {
-                    "ambulatorio": ambulatorio,
-                    "data": {"$gte": start_date, "$lt": end_date},
-                    "stato": {"$ne": "non_presentato"}
-                }
-                if tipo and tipo not in ["tutti", "IMPIANTI"]:
-                    query["tipo"] = tipo
-                
-                appointments = await db.appointments.find(query).to_list(10000)
-                
-                # Impianti
-                imp_query = {"ambulatorio": ambulatorio, "data_impianto": {"$gte": start_date, "$lt": end_date}}
-                impianti = await db.schede_impianto_picc.find(imp_query).to_list(10000)
-                
-                prestazioni_count = {}
-                for app in appointments:
-                    for prest in app.get("prestazioni", []):
-                        prestazioni_count[prest] = prestazioni_count.get(prest, 0) + 1
-                
-                return {
-                    "accessi": len(appointments),
-                    "pazienti_unici": len(set(a["patient_id"] for a in appointments)),
-                    "prestazioni": prestazioni_count,
-                    "impianti": len(impianti)
-                }
-            
-            stats1 = await get_stats_for_period(anno1, mese1, tipo)
-            stats2 = await get_stats_for_period(anno2, mese2, tipo)
-            
-            periodo1_label = f"{MESI[mese1]} {anno1}" if mese1 else f"Anno {anno1}"
-            periodo2_label = f"{MESI[mese2]} {anno2}" if mese2 else f"Anno {anno2}"
-            
-            # Calculate differences
-            diff_accessi = stats2["accessi"] - stats1["accessi"]
-            diff_pazienti = stats2["pazienti_unici"] - stats1["pazienti_unici"]
-            diff_impianti = stats2["impianti"] - stats1["impianti"]
-            
-            def format_diff(val):
-                if val > 0:
-                    return f"📈 +{val}"
-                elif val < 0:
-                    return f"📉 {val}"
-                return "➡️ 0"
-            
-            msg = f"📊 **Confronto Statistiche**\n\n"
-            msg += f"**{periodo1_label}** vs **{periodo2_label}**\n\n"
-            msg += f"| Metrica | {periodo1_label} | {periodo2_label} | Diff |\n"
-            msg += f"|---------|---------|---------|------|\n"
-            msg += f"| Accessi | {stats1['accessi']} | {stats2['accessi']} | {format_diff(diff_accessi)} |\n"
-            msg += f"| Pazienti | {stats1['pazienti_unici']} | {stats2['pazienti_unici']} | {format_diff(diff_pazienti)} |\n"
-            msg += f"| Impianti | {stats1['impianti']} | {stats2['impianti']} | {format_diff(diff_impianti)} |\n"
-            
-            if generate_pdf:
-                msg += "\n\n📥 Clicca 'Scarica PDF' per il report completo."
-            
-            result = {
-                "success": True,
-                "message": msg,
-                "stats1": stats1,
-                "stats2": stats2,
-                "periodo1": periodo1_label,
-                "periodo2": periodo2_label
-            }
-            
-            if generate_pdf:
-                result["pdf_endpoint"] = f"/statistics/compare/pdf?ambulatorio={ambulatorio}&anno1={anno1}&mese1={mese1 or ''}&anno2={anno2}&mese2={mese2 or ''}&tipo={tipo}"
-                result["filename"] = f"confronto_{periodo1_label}_{periodo2_label}.pdf"
-            
-            return result
+        if patient.get("status") == "sospeso":
+            errors.append(f"{patient['cognome']} {patient['nome']}: già sospeso")
+            continue
         
-        # ==================== PRINT PATIENT FOLDER ====================
-        elif action_type == "print_patient_folder":
-            patient_name = params.get("patient_name", "")
-            sezione = params.get("sezione", "completa")
-            patient = await find_patient(patient_name)
-            
-            if not patient:
-                return {"success": False, "message": f"❌ Paziente '{patient_name}' non trovato"}
-            
-            sezione_labels = {
-                "completa": "Cartella Completa",
-                "anagrafica": "Anagrafica",
-                "impianto": "Scheda Impianto",
-                "gestione_picc": "Gestione PICC",
-                "scheda_med": "Scheda Medicazione"
-            }
-            
-            label = sezione_labels.get(sezione, sezione)
-            
-            return {
-                "success": True,
-                "message": f"📄 **PDF Pronto!**\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Sezione: {label}\n\nClicca 'Scarica PDF' per scaricare.",
-                "pdf_endpoint": f"/patients/{patient['id']}/export/pdf?sezione={sezione}",
-                "filename": f"{patient['cognome']}_{patient['nome']}_{sezione}.pdf"
-            }
+        previous_status = patient.get("status", "in_cura")
+        undo_data.append({"patient_id": patient["id"], "previous_status": previous_status})
         
-        # ==================== CREATE MULTIPLE PATIENTS (BATCH) ====================
-        elif action_type == "create_multiple_patients":
-            patients_data = params.get("patients", [])
-            
-            if not patients_data:
-                return {"success": False, "message": "❌ Nessun paziente da creare. Fornisci una lista di pazienti."}
-            
-            created = []
-            errors = []
-            patient_ids = []
-            
-            for p in patients_data:
-                try:
-                    patient_data = {
-                        "id": str(uuid.uuid4()),
-                        "nome": p.get("nome", ""),
-                        "cognome": p.get("cognome", ""),
-                        "tipo": p.get("tipo", "PICC"),
-                        "ambulatorio": ambulatorio,
-                        "status": "in_cura",
-                        "created_at": datetime.now(timezone.utc).isoformat(),
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }
-                    await db.patients.insert_one(patient_data)
-                    created.append(f"{p.get('cognome', '')} {p.get('nome', '')} ({p.get('tipo', 'PICC')})")
-                    patient_ids.append(patient_data["id"])
-                except Exception as e:
-                    errors.append(f"{p.get('cognome', '')} {p.get('nome', '')}: {str(e)}")
-            
-            if created:
-                # Salva per undo
-                await save_undo_action(
-                    user_id, ambulatorio, "create_multiple_patients",
-                    f"Creati {len(created)} pazienti",
-                    {"patient_ids": patient_ids}
-                )
-            
-            msg = f"✅ **Creati {len(created)} pazienti:**\n\n"
-            for name in created:
-                msg += f"• {name}\n"
-            
-            if errors:
-                msg += f"\n\n⚠️ **Errori ({len(errors)}):**\n"
-                for err in errors:
-                    msg += f"• {err}\n"
-            
-            msg += "\n💡 Puoi annullare dicendo 'annulla'"
-            
-            return {"success": True, "created": len(created), "errors": len(errors), "message": msg, "can_undo": True}
+        updates.append(UpdateOne({"id": patient["id"]}, {"$set": {"status": "sospeso", "updated_at": now_iso}}))
+        patient["status"] = "sospeso"  # mantiene coerente il memo se il nome è ripetuto
+        suspended.append(f"{patient['cognome']} {patient['nome']}")
+    
+    if updates:
+        await db.patients.bulk_write(updates, ordered=False)
+    
+    if suspended:
+        run_in_background(save_undo_action(
+            user_id, ambulatorio, "suspend_multiple_patients",
+            f"Sospesi {len(suspended)} pazienti",
+            {"patients_data": undo_data}
+        ))
+    
+    msg = batch_message(
+        f"✅ **Sospesi {len(suspended)} pazienti:**", suspended,
+        f"\n⚠️ **Non processati ({len(errors)}):**\n", errors,
+        "\n💡 Puoi annullare dicendo 'annulla'"
+    )
+    
+    return {"success": True, "suspended": len(suspended), "errors": len(errors), "message": msg, "can_undo": True}
+
+# ==================== RESUME MULTIPLE PATIENTS (BATCH) ====================
+@ai_handler("resume_multiple_patients")
+async def _handle_resume_multiple_patients(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_names = params.get("patient_names", [])
+    
+    if not patient_names:
+        return {"success": False, "message": "❌ Nessun paziente specificato."}
+    
+    resumed = []
+    errors = []
+    undo_data = []
+    updates = []
+    now_iso = ai_now().isoformat()
+    
+    for name, patient in await find_patients(patient_names, ambulatorio):
+        if not patient:
+            errors.append(f"{name}: non trovato")
+            continue
         
-        # ==================== SUSPEND MULTIPLE PATIENTS (BATCH) ====================
-        elif action_type == "suspend_multiple_patients":
-            patient_names = params.get("patient_names", [])
-            
-            if not patient_names:
-                return {"success": False, "message": "❌ Nessun paziente specificato."}
-            
-            suspended = []
-            errors = []
-            undo_data = []
-            
-            for name in patient_names:
-                patient = await find_patient(name)
-                if not patient:
-                    errors.append(f"{name}: non trovato")
-                    continue
-                
-                if patient.get("status") == "sospeso":
-                    errors.append(f"{patient['cognome']} {patient['nome']}: già sospeso")
-                    continue
-                
-                previous_status = patient.get("status", "in_cura")
-                undo_data.append({"patient_id": patient["id"], "previous_status": previous_status})
-                
-                await db.patients.update_one(
-                    {"id": patient["id"]},
-                    {"$set": {"status": "sospeso", "updated_at": datetime.now(timezone.utc).isoformat()}}
-                )
-                suspended.append(f"{patient['cognome']} {patient['nome']}")
-            
-            if suspended:
-                await save_undo_action(
-                    user_id, ambulatorio, "suspend_multiple_patients",
-                    f"Sospesi {len(suspended)} pazienti",
-                    {"patients_data": undo_data}
-                )
-            
-            msg = f"✅ **Sospesi {len(suspended)} pazienti:**\n\n"
-            for name in suspended:
-                msg += f"• {name}\n"
-            
-            if errors:
-                msg += f"\n⚠️ **Non processati ({len(errors)}):**\n"
-                for err in errors:
-                    msg += f"• {err}\n"
-            
-            msg += "\n💡 Puoi annullare dicendo 'annulla'"
-            
-            return {"success": True, "suspended": len(suspended), "errors": len(errors), "message": msg, "can_undo": True}
+        if patient.get("status") == "in_cura":
+            errors.append(f"{patient['cognome']} {patient['nome']}: già in cura")
+            continue
         
-        # ==================== RESUME MULTIPLE PATIENTS (BATCH) ====================
-        elif action_type == "resume_multiple_patients":
-            patient_names = params.get("patient_names", [])
-            
-            if not patient_names:
-                return {"success": False, "message": "❌ Nessun paziente specificato."}
-            
-            resumed = []
-            errors = []
-            undo_data = []
-            
-            for name in patient_names:
-                patient = await find_patient(name)
-                if not patient:
-                    errors.append(f"{name}: non trovato")
-                    continue
-                
-                if patient.get("status") == "in_cura":
-                    errors.append(f"{patient['cognome']} {patient['nome']}: già in cura")
-                    continue
-                
-                previous_status = patient.get("status", "sospeso")
-                undo_data.append({"patient_id": patient["id"], "previous_status": previous_status})
-                
-                await db.patients.update_one(
-                    {"id": patient["id"]},
-                    {"$set": {"status": "in_cura", "updated_at": datetime.now(timezone.utc).isoformat()}}
-                )
-                resumed.append(f"{patient['cognome']} {patient['nome']}")
-            
-            if resumed:
-                await save_undo_action(
-                    user_id, ambulatorio, "resume_multiple_patients",
-                    f"Ripresi in cura {len(resumed)} pazienti",
-                    {"patients_data": undo_data}
-                )
-            
-            msg = f"✅ **Ripresi in cura {len(resumed)} pazienti:**\n\n"
-            for name in resumed:
-                msg += f"• {name}\n"
-            
-            if errors:
-                msg += f"\n⚠️ **Non processati ({len(errors)}):**\n"
-                for err in errors:
-                    msg += f"• {err}\n"
-            
-            msg += "\n💡 Puoi annullare dicendo 'annulla'"
-            
-            return {"success": True, "resumed": len(resumed), "errors": len(errors), "message": msg, "can_undo": True}
+        previous_status = patient.get("status", "sospeso")
+        undo_data.append({"patient_id": patient["id"], "previous_status": previous_status})
         
-        # ==================== DISCHARGE MULTIPLE PATIENTS (BATCH) ====================
-        elif action_type == "discharge_multiple_patients":
-            patient_names = params.get("patient_names", [])
-            
-            if not patient_names:
-                return {"success": False, "message": "❌ Nessun paziente specificato."}
-            
-            discharged = []
-            errors = []
-            undo_data = []
-            
-            for name in patient_names:
-                patient = await find_patient(name)
-                if not patient:
-                    errors.append(f"{name}: non trovato")
-                    continue
-                
-                if patient.get("status") == "dimesso":
-                    errors.append(f"{patient['cognome']} {patient['nome']}: già dimesso")
-                    continue
-                
-                previous_status = patient.get("status", "in_cura")
-                previous_data = {"data_dimissione": patient.get("data_dimissione")}
-                undo_data.append({"patient_id": patient["id"], "previous_status": previous_status, "previous_data": previous_data})
-                
-                await db.patients.update_one(
-                    {"id": patient["id"]},
-                    {"$set": {"status": "dimesso", "data_dimissione": datetime.now().strftime("%Y-%m-%d"), "updated_at": datetime.now(timezone.utc).isoformat()}}
-                )
-                discharged.append(f"{patient['cognome']} {patient['nome']}")
-            
-            if discharged:
-                await save_undo_action(
-                    user_id, ambulatorio, "discharge_multiple_patients",
-                    f"Dimessi {len(discharged)} pazienti",
-                    {"patients_data": undo_data}
-                )
-            
-            msg = f"✅ **Dimessi {len(discharged)} pazienti:**\n\n"
-            for name in discharged:
-                msg += f"• {name}\n"
-            
-            if errors:
-                msg += f"\n⚠️ **Non processati ({len(errors)}):**\n"
-                for err in errors:
-                    msg += f"• {err}\n"
-            
-            msg += "\n💡 Puoi annullare dicendo 'annulla'"
-            
-            return {"success": True, "discharged": len(discharged), "errors": len(errors), "message": msg, "can_undo": True}
+        updates.append(UpdateOne({"id": patient["id"]}, {"$set": {"status": "in_cura", "updated_at": now_iso}}))
+        patient["status"] = "in_cura"
+        resumed.append(f"{patient['cognome']} {patient['nome']}")
+    
+    if updates:
+        await db.patients.bulk_write(updates, ordered=False)
+    
+    if resumed:
+        run_in_background(save_undo_action(
+            user_id, ambulatorio, "resume_multiple_patients",
+            f"Ripresi in cura {len(resumed)} pazienti",
+            {"patients_data": undo_data}
+        ))
+    
+    msg = batch_message(
+        f"✅ **Ripresi in cura {len(resumed)} pazienti:**", resumed,
+        f"\n⚠️ **Non processati ({len(errors)}):**\n", errors,
+        "\n💡 Puoi annullare dicendo 'annulla'"
+    )
+    
+    return {"success": True, "resumed": len(resumed), "errors": len(errors), "message": msg, "can_undo": True}
+
+# ==================== DISCHARGE MULTIPLE PATIENTS (BATCH) ====================
+@ai_handler("discharge_multiple_patients")
+async def _handle_discharge_multiple_patients(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_names = params.get("patient_names", [])
+    
+    if not patient_names:
+        return {"success": False, "message": "❌ Nessun paziente specificato."}
+    
+    discharged = []
+    errors = []
+    undo_data = []
+    updates = []
+    now_iso = ai_now().isoformat()
+    today = ai_today().strftime("%Y-%m-%d")
+    
+    for name, patient in await find_patients(patient_names, ambulatorio):
+        if not patient:
+            errors.append(f"{name}: non trovato")
+            continue
         
-        # ==================== DELETE MULTIPLE PATIENTS (BATCH) ====================
-        elif action_type == "delete_multiple_patients":
-            patient_names = params.get("patient_names", [])
-            
-            if not patient_names:
-                return {"success": False, "message": "❌ Nessun paziente specificato."}
-            
-            deleted = []
-            errors = []
-            all_backup_data = []
-            
-            for name in patient_names:
-                patient = await find_patient(name)
-                if not patient:
-                    errors.append(f"{name}: non trovato")
-                    continue
-                
-                patient_id = patient["id"]
-                nome_completo = f"{patient['cognome']} {patient['nome']}"
-                
-                # Backup data for undo
-                patient_data = {k: v for k, v in patient.items() if k != "_id"}
-                appointments = await db.appointments.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
-                schede_impianto = await db.schede_impianto_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(100)
-                schede_gestione = await db.schede_gestione_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(100)
-                schede_med = await db.schede_medicazione_med.find({"patient_id": patient_id}, {"_id": 0}).to_list(100)
-                prescrizioni_list = await db.prescrizioni.find({"patient_id": patient_id}, {"_id": 0}).to_list(100)
-                
-                all_backup_data.append({
-                    "patient_data": patient_data,
-                    "appointments": appointments,
-                    "schede_impianto": schede_impianto,
-                    "schede_gestione": schede_gestione,
-                    "schede_med": schede_med,
-                    "prescrizioni": prescrizioni_list
-                })
-                
-                # Delete all related data
-                await db.appointments.delete_many({"patient_id": patient_id})
-                await db.schede_impianto_picc.delete_many({"patient_id": patient_id})
-                await db.schede_gestione_picc.delete_many({"patient_id": patient_id})
-                await db.schede_medicazione_med.delete_many({"patient_id": patient_id})
-                await db.prescrizioni.delete_many({"patient_id": patient_id})
-                await db.patients.delete_one({"id": patient_id})
-                
-                deleted.append(nome_completo)
-            
-            if deleted:
-                await save_undo_action(
-                    user_id, ambulatorio, "delete_multiple_patients",
-                    f"Eliminati {len(deleted)} pazienti",
-                    {"all_backup_data": all_backup_data}
-                )
-            
-            msg = f"✅ **Eliminati definitivamente {len(deleted)} pazienti:**\n\n"
-            for name in deleted:
-                msg += f"• {name}\n"
-            
-            if errors:
-                msg += f"\n⚠️ **Non trovati ({len(errors)}):**\n"
-                for err in errors:
-                    msg += f"• {err}\n"
-            
-            msg += "\n\n⚠️ Tutti i dati dei pazienti sono stati eliminati.\n💡 **IMPORTANTE**: Puoi ancora annullare questa azione dicendo 'annulla'!"
-            
-            return {"success": True, "deleted": len(deleted), "errors": len(errors), "message": msg, "can_undo": True}
+        if patient.get("status") == "dimesso":
+            errors.append(f"{patient['cognome']} {patient['nome']}: già dimesso")
+            continue
         
-        # ==================== ADD EXTRACTED PATIENTS (from image) ====================
-        elif action_type == "add_extracted_patients":
-            patients_data = params.get("patients", [])
-            tipo_default = params.get("tipo_default", "PICC")
-            
-            if not patients_data:
-                return {"success": False, "message": "❌ Nessun paziente da aggiungere. Prima carica una foto con i nomi dei pazienti."}
-            
-            created = []
-            errors = []
-            patient_ids = []
-            
-            for p in patients_data:
-                try:
-                    patient_data = {
-                        "id": str(uuid.uuid4()),
-                        "nome": p.get("nome", ""),
-                        "cognome": p.get("cognome", ""),
-                        "tipo": p.get("tipo", tipo_default),
-                        "ambulatorio": ambulatorio,
-                        "status": "in_cura",
-                        "created_at": datetime.now(timezone.utc).isoformat(),
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }
-                    await db.patients.insert_one(patient_data)
-                    created.append(f"{p.get('cognome', '')} {p.get('nome', '')} ({p.get('tipo', tipo_default)})")
-                    patient_ids.append(patient_data["id"])
-                except Exception as e:
-                    errors.append(f"{p.get('cognome', '')} {p.get('nome', '')}: {str(e)}")
-            
-            if created:
-                await save_undo_action(
-                    user_id, ambulatorio, "create_multiple_patients",
-                    f"Creati {len(created)} pazienti da foto",
-                    {"patient_ids": patient_ids}
-                )
-            
-            msg = f"✅ **Creati {len(created)} pazienti dalla foto:**\n\n"
-            for name in created:
-                msg += f"• {name}\n"
-            
-            if errors:
-                msg += f"\n\n⚠️ **Errori ({len(errors)}):**\n"
-                for err in errors:
-                    msg += f"• {err}\n"
-            
-            msg += "\n💡 Puoi annullare dicendo 'annulla'"
-            
-            return {"success": True, "created": len(created), "errors": len(errors), "message": msg, "can_undo": True}
+        previous_status = patient.get("status", "in_cura")
+        previous_data = {"data_dimissione": patient.get("data_dimissione")}
+        undo_data.append({"patient_id": patient["id"], "previous_status": previous_status, "previous_data": previous_data})
         
+        updates.append(UpdateOne({"id": patient["id"]}, {"$set": {"status": "dimesso", "data_dimissione": today, "updated_at": now_iso}}))
+        patient["status"] = "dimesso"
+        discharged.append(f"{patient['cognome']} {patient['nome']}")
+    
+    if updates:
+        await db.patients.bulk_write(updates, ordered=False)
+    
+    if discharged:
+        run_in_background(save_undo_action(
+            user_id, ambulatorio, "discharge_multiple_patients",
+            f"Dimessi {len(discharged)} pazienti",
+            {"patients_data": undo_data}
+        ))
+    
+    msg = batch_message(
+        f"✅ **Dimessi {len(discharged)} pazienti:**", discharged,
+        f"\n⚠️ **Non processati ({len(errors)}):**\n", errors,
+        "\n💡 Puoi annullare dicendo 'annulla'"
+    )
+    
+    return {"success": True, "discharged": len(discharged), "errors": len(errors), "message": msg, "can_undo": True}
+
+# ==================== DELETE MULTIPLE PATIENTS (BATCH) ====================
+@ai_handler("delete_multiple_patients")
+async def _handle_delete_multiple_patients(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patient_names = params.get("patient_names", [])
+    
+    if not patient_names:
+        return {"success": False, "message": "❌ Nessun paziente specificato."}
+    
+    deleted = []
+    errors = []
+    all_backup_data = []
+    to_delete = {}
+    
+    for name, patient in await find_patients(patient_names, ambulatorio):
+        if not patient:
+            errors.append(f"{name}: non trovato")
+            continue
+        to_delete.setdefault(patient["id"], (name, patient))
+    
+    # Backup data for undo (documento completo: find_patient legge solo alcuni campi)
+    backups = await build_patients_backup(list(to_delete)) if to_delete else {}
+    
+    for patient_id, (name, patient) in to_delete.items():
+        backup = backups.get(patient_id)
+        if backup is None:
+            errors.append(f"{name}: non trovato")
+            continue
+        all_backup_data.append(backup)
+        forget_patient(patient)
+        deleted.append(f"{patient['cognome']} {patient['nome']}")
+    
+    # Salva per undo PRIMA di eliminare: il backup è l'unica copia dei dati
+    if all_backup_data:
+        await save_undo_action(
+            user_id, ambulatorio, "delete_multiple_patients",
+            f"Eliminati {len(deleted)} pazienti",
+            {"all_backup_data": all_backup_data}
+        )
+        # Delete all related data
+        await delete_patients_data([backup["patient_data"]["id"] for backup in all_backup_data])
+    
+    msg = batch_message(
+        f"✅ **Eliminati definitivamente {len(deleted)} pazienti:**", deleted,
+        f"\n⚠️ **Non trovati ({len(errors)}):**\n", errors,
+        "\n\n⚠️ Tutti i dati dei pazienti sono stati eliminati.\n💡 **IMPORTANTE**: Puoi ancora annullare questa azione dicendo 'annulla'!"
+    )
+    
+    return {"success": True, "deleted": len(deleted), "errors": len(errors), "message": msg, "can_undo": True}
+
+# ==================== ADD EXTRACTED PATIENTS (from image) ====================
+@ai_handler("add_extracted_patients")
+async def _handle_add_extracted_patients(params: dict, ambulatorio: str, user_id: str) -> dict:
+    patients_data = params.get("patients", [])
+    tipo_default = params.get("tipo_default", "PICC")
+    
+    if not patients_data:
+        return {"success": False, "message": "❌ Nessun paziente da aggiungere. Prima carica una foto con i nomi dei pazienti."}
+    
+    created, errors, patient_ids = await insert_ai_patients(patients_data, ambulatorio, tipo_default)
+    
+    if created:
+        run_in_background(save_undo_action(
+            user_id, ambulatorio, "create_multiple_patients",
+            f"Creati {len(created)} pazienti da foto",
+            {"patient_ids": patient_ids}
+        ))
+    
+    msg = batch_message(
+        f"✅ **Creati {len(created)} pazienti dalla foto:**", created,
+        f"\n\n⚠️ **Errori ({len(errors)}):**\n", errors,
+        "\n💡 Puoi annullare dicendo 'annulla'"
+    )
+    
+    return {"success": True, "created": len(created), "errors": len(errors), "message": msg, "can_undo": True}
+
+async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dict:
+    """Execute an action determined by AI - VERSIONE COMPLETA"""
+    handler = AI_ACTION_HANDLERS.get(action.get("action"))
+    if handler is None:
         return {"success": False, "message": "❌ Azione non riconosciuta. Prova a riformulare la richiesta."}
-        
+    
+    _patient_cache.set({})
+    _ai_now.set(datetime.now(timezone.utc))
+    try:
+        return await handler(action.get("params", {}), ambulatorio, user_id)
     except Exception as e:
         logger.error(f"Action error: {str(e)}")
         return {"success": False, "message": f"❌ Errore nell'esecuzione: {str(e)}"}
@@ -4517,7 +4933,6 @@ async def ai_chat(
     user_id = payload.get("sub", "unknown")
     session_id = request.session_id or str(uuid.uuid4())
     
-    # Save user message
     user_msg = {
         "id": str(uuid.uuid4()),
         "session_id": session_id,
@@ -4527,7 +4942,6 @@ async def ai_chat(
         "content": request.message,
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    await db.ai_chat_history.insert_one(user_msg)
     
     # Get AI response
     ai_result = await get_ai_response(request.message, session_id, request.ambulatorio.value, user_id)
@@ -4552,7 +4966,8 @@ async def ai_chat(
         "content": ai_result["response"],
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    await db.ai_chat_history.insert_one(assistant_msg)
+    # Domanda e risposta salvate insieme; la domanda corrente è già nel prompt, non serve nello storico letto
+    await db.ai_chat_history.insert_many([user_msg, assistant_msg])
     
     return {
         "response": ai_result["response"],
@@ -4562,6 +4977,38 @@ async def ai_chat(
 
 # Import for image processing - use OpenAI directly for vision
 import openai
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+OPENAI_BASE_URL = "https://integrations.emergentagent.com/llm/openai/v1"
+_openai_client: Optional[openai.AsyncOpenAI] = None
+
+def get_openai_client(api_key: str) -> openai.AsyncOpenAI:
+    """Client condiviso tra le richieste: riusa il pool di connessioni (e le sessioni TLS)"""
+    global _openai_client
+    if _openai_client is None or _openai_client.api_key != api_key:
+        if _openai_client is not None:
+            # Chiave cambiata: chiude il pool di connessioni del vecchio client
+            run_in_background(_openai_client.close())
+        _openai_client = openai.AsyncOpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, max_retries=2, timeout=60)
+    return _openai_client
+
+VISION_MAX_SIDE = 2048  # oltre questo lato il modello ridimensiona comunque l'immagine
+
+def encode_vision_image(contents: bytes, content_type: str) -> tuple:
+    """Base64 dell'immagine da inviare al modello; le foto più grandi di VISION_MAX_SIDE
+    vengono ridotte e ricodificate in JPEG (payload e latenza molto minori)"""
+    try:
+        img = Image.open(io.BytesIO(contents))
+        if max(img.size) > VISION_MAX_SIDE:
+            # Applica l'orientamento EXIF: il JPEG ricodificato non conserva il tag
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE))
+            buf = io.BytesIO()
+            img.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+            contents, content_type = buf.getvalue(), "image/jpeg"
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        pass  # formato non riconosciuto o immagine anomala: invia l'originale
+    return base64.b64encode(contents).decode('ascii'), content_type
 
 @api_router.post("/ai/extract-from-image")
 async def extract_patients_from_image(
@@ -4581,16 +5028,13 @@ async def extract_patients_from_image(
         
         # Read and encode image
         contents = await file.read()
-        image_base64 = base64.b64encode(contents).decode('utf-8')
-        
-        # Determine content type
-        content_type = file.content_type or "image/png"
+        # Ridimensiona e codifica fuori dall'event loop: con scansioni di diversi MB bloccherebbe le altre richieste
+        image_base64, content_type = await asyncio.to_thread(
+            encode_vision_image, contents, file.content_type or "image/png"
+        )
         
         # Use OpenAI directly with vision capability
-        client = openai.AsyncOpenAI(
-            api_key=api_key,
-            base_url="https://integrations.emergentagent.com/llm/openai/v1"
-        )
+        client = get_openai_client(api_key)
         
         # Create the message with image
         response = await client.chat.completions.create(
@@ -4629,38 +5073,37 @@ Se non riesci a identificare nomi, restituisci: {"patients": [], "error": "Nessu
                     ]
                 }
             ],
-            max_tokens=4096
+            max_tokens=2048,
+            stream=True
         )
         
-        response_text = response.choices[0].message.content
+        chunks = []
+        async for chunk in response:
+            if chunk.choices:
+                chunks.append(chunk.choices[0].delta.content or "")
+        response_text = "".join(chunks)
         logger.info(f"AI Vision response: {response_text[:500]}")
         
         # Parse response
         try:
             # Try to find JSON in the response
-            # Handle markdown code blocks
-            if "```json" in response_text:
-                json_match = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group(1))
-                else:
-                    result = json.loads(response_text.strip())
-            elif "```" in response_text:
-                json_match = re.search(r'```\s*(.*?)\s*```', response_text, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group(1))
-                else:
-                    result = json.loads(response_text.strip())
+            # Handle markdown code blocks: contenuto tra la riga di apertura ``` e la chiusura
+            fence = response_text.find("```")
+            if fence != -1:
+                body_start = response_text.find("\n", fence)
+                body_start = body_start + 1 if body_start != -1 else fence + 3
+                body_end = response_text.find("```", body_start)
+                candidate = response_text[body_start:body_end] if body_end != -1 else response_text[body_start:]
             else:
                 # Try to find JSON object directly
-                json_match = re.search(r'\{.*"patients".*\}', response_text, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group())
-                else:
-                    result = json.loads(response_text.strip())
+                span = _find_json_object(response_text)
+                candidate = response_text[span[0]:span[1]] if span else response_text
+            result = json.loads(candidate.strip())
         except json.JSONDecodeError as e:
-            logger.error(f"JSON parse error: {e}, response: {response_text}")
-            result = {"patients": [], "raw_response": response_text, "error": str(e)}
+            result = _extract_json(response_text)
+            if result is None:
+                logger.error(f"JSON parse error: {e}, response: {response_text}")
+                result = {"patients": [], "raw_response": response_text, "error": str(e)}
         
         patients = result.get("patients", [])
         
@@ -4697,17 +5140,22 @@ async def get_ai_history(
     if session_id:
         query["session_id"] = session_id
     
-    messages = await db.ai_chat_history.find(query, {"_id": 0}).sort("timestamp", -1).to_list(100)
-    
-    # Group by session
-    sessions = {}
-    for msg in messages:
-        sid = msg["session_id"]
-        if sid not in sessions:
-            sessions[sid] = {"session_id": sid, "messages": [], "last_message": msg["timestamp"]}
-        sessions[sid]["messages"].append(msg)
+    # Ultimi 100 messaggi raggruppati per sessione (sessione più recente per prima)
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"timestamp": -1}},
+        {"$limit": 100},
+        {"$project": {"_id": 0}},
+        {"$group": {
+            "_id": "$session_id",
+            "messages": {"$push": "$$ROOT"},
+            "last_message": {"$first": "$timestamp"}
+        }},
+        {"$sort": {"last_message": -1}},
+        {"$project": {"_id": 0, "session_id": "$_id", "messages": 1, "last_message": 1}}
+    ]
     
-    return list(sessions.values())
+    return await db.ai_chat_history.aggregate(pipeline).to_list(None)
 
 @api_router.get("/ai/sessions")
 async def get_ai_sessions(
@@ -4730,11 +5178,22 @@ async def get_ai_sessions(
             "message_count": {"$sum": 1}
         }},
         {"$sort": {"last_timestamp": -1}},
-        {"$limit": 20}
+        {"$limit": 20},
+        # Anteprima dell'ultimo messaggio troncata a 50 caratteri direttamente in MongoDB
+        {"$project": {
+            "_id": 0,
+            "session_id": "$_id",
+            "last_message": {"$cond": [
+                {"$gt": [{"$strLenCP": "$last_message"}, 50]},
+                {"$concat": [{"$substrCP": ["$last_message", 0, 50]}, "..."]},
+                "$last_message"
+            ]},
+            "last_timestamp": 1,
+            "message_count": 1
+        }}
     ]
     
-    sessions = await db.ai_chat_history.aggregate(pipeline).to_list(20)
-    return [{"session_id": s["_id"], "last_message": s["last_message"][:50] + "..." if len(s["last_message"]) > 50 else s["last_message"], "last_timestamp": s["last_timestamp"], "message_count": s["message_count"]} for s in sessions]
+    return await db.ai_chat_history.aggregate(pipeline).to_list(20)
 
 @api_router.delete("/ai/session/{session_id}")
 async def delete_ai_session(
@@ -4753,6 +5212,7 @@ async def delete_ai_session(
         "user_id": user_id,
         "ambulatorio": ambulatorio.value
     })
+    _ai_chats.pop(session_id, None)
     
     return {"deleted": result.deleted_count}
 
@@ -4775,16 +5235,89 @@ async def clear_ai_history(
     return {"deleted": result.deleted_count}
 
 # ============== GOOGLE SHEETS SYNC ==============
-import csv
+import bisect
+import copy
 import httpx
-import re as regex_module
 from openpyxl import load_workbook
 from rapidfuzz import fuzz, process
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 GOOGLE_SHEET_ID = "1gO9i0IuoReM0yto7GqQlIMWjdrzDToDWJ9dQ8z0badE"
+
+# Client HTTP condiviso: riusa le connessioni keep-alive verso docs.google.com
+_sheets_http_client = httpx.AsyncClient(
+    follow_redirects=True,
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+)
+
+# Ultimo parsing per foglio: {(sheet_id, anno, colori): (etag, [(nome scheda, appuntamenti, pazienti)])}
+# Si conserva il risultato (piccolo), non il workbook openpyxl (centinaia di MB con gli stili)
+_sheet_data_cache = TTLCache(maxsize=16, ttl=6 * 3600)
+_sheet_locks = {}  # {sheet_id: [lock, richieste in attesa]}, rimosso quando nessuno lo usa
+
+async def load_sheet_data(sheet_id: str, year: int, read_colors: bool = True) -> list:
+    """Scarica l'export XLSX del foglio (GET condizionale con ETag) e restituisce
+    [(nome scheda, appuntamenti, pazienti)]; se il foglio non è cambiato riusa il parsing precedente"""
+    entry = _sheet_locks.setdefault(sheet_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            sheets = await _fetch_sheet_data(sheet_id, year, read_colors)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _sheet_locks[sheet_id]
+    # Copia: i chiamanti modificano gli appuntamenti (correzioni dei nomi)
+    return copy.deepcopy(sheets)
+
+async def _fetch_sheet_data(sheet_id: str, year: int, read_colors: bool) -> list:
+    cache_key = (sheet_id, year, read_colors)
+    cached = _sheet_data_cache.get(cache_key)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    
+    xlsx_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=xlsx"
+    response = await _sheets_http_client.get(xlsx_url, headers=headers)
+    if response.status_code == 304 and cached:
+        return cached[1]
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail=f"Impossibile accedere al foglio Google (status {response.status_code}). Verifica che sia pubblico.")
+    
+    sheets = await asyncio.to_thread(parse_workbook, response.content, year, read_colors)
+    etag = response.headers.get("etag")
+    if etag:
+        _sheet_data_cache[cache_key] = (etag, sheets)
+    return sheets
+
+def parse_workbook(content: bytes, year: int, read_colors: bool) -> list:
+    """Parse di tutte le schede del workbook: [(nome scheda, appuntamenti, pazienti)]"""
+    # data_only=True valuta le formule e mantiene comunque gli stili (colori del font)
+    wb = load_workbook(io.BytesIO(content), data_only=True)
+    sheets = []
+    for sheet_name in wb.sheetnames:
+        ws = wb[sheet_name]
+        
+        # Salta fogli vuoti o con pochi dati
+        if ws.max_row < 7 or ws.max_column < 5:
+            continue
+        
+        appointments, patients = parse_sheet_data(ws, year, read_colors)
+        if appointments:
+            sheets.append((sheet_name, appointments, patients))
+    return sheets
+
 SIMILARITY_THRESHOLD = 80  # Soglia di similarità per considerare un potenziale errore
 
+# Separatore tra più pazienti nella stessa cella
+_SPLIT_NAMES_RE = re.compile(r'[/,]')
+# Note da ignorare nelle celle (non sono nomi di pazienti)
+_IGNORE_KW_RE = re.compile(r'controllo|rim |non funzionante|picc port|idline|clody im|spatoliatore', re.IGNORECASE)
+# Cognome (prima parola) e nome (resto della cella)
+_NAME_RE = re.compile(r'(\S+)(?:\s+(.+))?', re.DOTALL)
+
+def _cap(s: str) -> str:
+    return s[:1].upper() + s[1:].lower()
+
 class GoogleSheetsSyncRequest(BaseModel):
     ambulatorio: Ambulatorio
     sheet_id: Optional[str] = None
@@ -4895,16 +5428,13 @@ def is_red_color(color_value):
             pass
     return False
 
-def parse_sheet_data(ws, year, ws_with_colors=None):
+def parse_sheet_data(ws, year, read_colors=True):
     """Parse una singola scheda Excel e restituisce appuntamenti e pazienti
-    ws_with_colors: worksheet caricato senza data_only per leggere i colori
+    read_colors: legge il colore del font (rosso = non presentato); l'analisi non ne ha bisogno
     """
-    appointments = []
+    appointments = {}  # {(cognome, nome, data, ora): appuntamento} - un paziente per slot, anche se in più colonne
     patients = set()
     
-    # Usa ws_with_colors se disponibile per i colori
-    color_ws = ws_with_colors or ws
-    
     # Struttura del foglio:
     # Riga 3: date (possono essere datetime o stringhe DD/MM)
     # Riga 6: tipi PICC/MEDICAZIONI
@@ -4948,11 +5478,8 @@ def parse_sheet_data(ws, year, ws_with_colors=None):
         tipo_cell = str(cell_value).strip().upper()
         
         # Trova la data più vicina a sinistra
-        closest_date = None
-        for boundary in reversed(date_boundaries):
-            if boundary <= col:
-                closest_date = date_for_col[boundary]
-                break
+        pos = bisect.bisect_right(date_boundaries, col) - 1
+        closest_date = date_for_col[date_boundaries[pos]] if pos >= 0 else None
         
         if closest_date:
             if "PICC" in tipo_cell and "MED" not in tipo_cell:
@@ -4982,45 +5509,49 @@ def parse_sheet_data(ws, year, ws_with_colors=None):
         
         # Scansiona le colonne mappate
         for col, mapping in column_mapping.items():
-            cell_value = ws.cell(row=row, column=col).value
+            sheet_cell = ws.cell(row=row, column=col)
+            cell_value = sheet_cell.value
             if cell_value:
                 cell = str(cell_value).strip()
                 if cell and cell not in ["", "-"]:
                     # Controlla se la cella è rossa (non presentato)
                     is_not_presented = False
-                    try:
-                        color_cell = color_ws.cell(row=row, column=col)
-                        font_color = color_cell.font.color
-                        if font_color and font_color.rgb:
-                            is_not_presented = is_red_color(font_color.rgb)
-                    except:
-                        pass
+                    if read_colors:
+                        try:
+                            font_color = sheet_cell.font.color
+                            if font_color and font_color.rgb:
+                                is_not_presented = is_red_color(font_color.rgb)
+                        except:
+                            pass
                     
                     # Può contenere più nomi separati da / o ,
-                    names = regex_module.split(r'[/,]', cell)
+                    names = _SPLIT_NAMES_RE.split(cell)
                     for name in names:
                         name = name.strip()
                         if name and len(name) > 1:
                             # Ignora note
-                            if any(kw in name.lower() for kw in ["controllo", "rim ", "non funzionante", "picc port", "idline", "clody im", "spatoliatore"]):
+                            if _IGNORE_KW_RE.search(name):
                                 continue
                             
-                            parts = name.split()
-                            if parts:
-                                cognome = parts[0].capitalize()
-                                nome = " ".join(parts[1:]).capitalize() if len(parts) > 1 else ""
-                                
-                                patients.add((cognome, nome))
-                                appointments.append({
-                                    "date": mapping["date"],
-                                    "ora": ora,
-                                    "tipo": mapping["tipo"],
-                                    "cognome": cognome,
-                                    "nome": nome,
-                                    "not_presented": is_not_presented  # Nuovo campo
-                                })
-    
-    return appointments, patients
+                            m = _NAME_RE.match(name)
+                            cognome = _cap(m.group(1))
+                            # Spazi multipli, tab e a capo nel nome ridotti a uno (come nei pazienti già importati)
+                            nome = _cap(" ".join(m.group(2).split())) if m.group(2) else ""
+                            
+                            patients.add((cognome, nome))
+                            apt = appointments.setdefault((cognome, nome, mapping["date"], ora), {
+                                "date": mapping["date"],
+                                "ora": ora,
+                                "tipi": [],  # colonne (PICC/MED) in cui compare, in ordine
+                                "cognome": cognome,
+                                "nome": nome,
+                                "not_presented": False  # Nuovo campo
+                            })
+                            if mapping["tipo"] not in apt["tipi"]:
+                                apt["tipi"].append(mapping["tipo"])
+                            apt["not_presented"] = apt["not_presented"] or is_not_presented
+    
+    return list(appointments.values()), patients
 
 @api_router.post("/sync/google-sheets")
 async def sync_from_google_sheets(
@@ -5036,20 +5567,7 @@ async def sync_from_google_sheets(
     
     try:
         # Scarica il foglio come XLSX (contiene tutti i fogli)
-        xlsx_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=xlsx"
-        
-        async with httpx.AsyncClient(follow_redirects=True) as http_client:
-            response = await http_client.get(xlsx_url, timeout=60.0)
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Impossibile accedere al foglio Google (status {response.status_code}). Verifica che sia pubblico.")
-        
-        xlsx_content = io.BytesIO(response.content)
-        
-        # Carica il workbook due volte:
-        # 1. Con data_only=True per valutare le formule
-        # 2. Senza data_only per leggere i colori
-        wb_data = load_workbook(io.BytesIO(response.content), data_only=True)
-        wb_colors = load_workbook(io.BytesIO(response.content), data_only=False)
+        sheets = await load_sheet_data(sheet_id, year)
         
         # NON cancellare gli appuntamenti manuali!
         # Cancella solo gli appuntamenti importati da Google Sheets
@@ -5064,20 +5582,11 @@ async def sync_from_google_sheets(
         all_patients = set()
         sheets_processed = []
         
-        for sheet_name in wb_data.sheetnames:
-            ws_data = wb_data[sheet_name]
-            ws_colors = wb_colors[sheet_name] if sheet_name in wb_colors.sheetnames else None
-            
-            # Salta fogli vuoti o con pochi dati
-            if ws_data.max_row < 7 or ws_data.max_column < 5:
-                continue
-            
-            appointments, patients = parse_sheet_data(ws_data, year, ws_colors)
-            if appointments:
-                all_appointments.extend(appointments)
-                all_patients.update(patients)
-                sheets_processed.append(sheet_name)
-                logger.info(f"Foglio '{sheet_name}': {len(appointments)} appuntamenti")
+        for sheet_name, appointments, patients in sheets:
+            all_appointments.extend(appointments)
+            all_patients.update(patients)
+            sheets_processed.append(sheet_name)
+            logger.info(f"Foglio '{sheet_name}': {len(appointments)} appuntamenti")
         
         logger.info(f"Totale: {len(all_appointments)} appuntamenti da {len(sheets_processed)} fogli")
         
@@ -5108,34 +5617,52 @@ async def sync_from_google_sheets(
             all_patients = new_patients
         
         # Crea/trova pazienti e appuntamenti
-        created_patients = 0
-        created_appointments = 0
+        now_iso = datetime.now(timezone.utc).isoformat()
         skipped_appointments = 0
         
         patient_id_map = {}  # {(cognome, nome): patient_id}
         
+        # Cerca tutti i pazienti esistenti con una sola query sull'indice (ambulatorio, cognome_lc)
+        existing_patients = await db.patients.find(
+            {
+                "ambulatorio": data.ambulatorio.value,
+                "cognome_lc": {"$in": list({cognome.lower() for cognome, _ in all_patients})}
+            },
+            {"_id": 0, "id": 1, "cognome_lc": 1, "nome_lc": 1}
+        ).to_list(None)
+        existing_by_name = {}  # {(cognome_lc, nome_lc): patient_id}
+        existing_by_cognome = {}  # {cognome_lc: patient_id} per le celle senza nome
+        for p in existing_patients:
+            existing_by_name.setdefault((p["cognome_lc"], p.get("nome_lc", "")), p["id"])
+            existing_by_cognome.setdefault(p["cognome_lc"], p["id"])
+        
+        new_patients = []
+        # Codici già in uso, per generare quelli nuovi senza interrogare il DB a ogni tentativo
+        used_codes = set(await db.patients.distinct("codice_paziente"))
+        # Tipi di appuntamento (PICC/MED) per ciascun paziente del foglio
+        tipos_by_name = defaultdict(set)
+        for apt in all_appointments:
+            tipos_by_name[(apt["cognome"], apt["nome"])].update(apt["tipi"])
+        
         for cognome, nome in all_patients:
             # Cerca paziente esistente
-            query = {"cognome": {"$regex": f"^{cognome}$", "$options": "i"}, "ambulatorio": data.ambulatorio.value}
             if nome:
-                query["nome"] = {"$regex": f"^{nome}$", "$options": "i"}
-            
-            existing = await db.patients.find_one(query, {"_id": 0})
+                existing_id = existing_by_name.get((cognome.lower(), nome.lower()))
+            else:
+                existing_id = existing_by_cognome.get(cognome.lower())
             
-            if existing:
-                patient_id_map[(cognome, nome)] = existing["id"]
+            if existing_id:
+                patient_id_map[(cognome, nome)] = existing_id
             else:
                 # Crea nuovo paziente
                 new_patient_id = str(uuid.uuid4())
                 codice_paziente = generate_patient_code(nome or "X", cognome)
-                while await db.patients.find_one({"codice_paziente": codice_paziente}):
+                while codice_paziente in used_codes:
                     codice_paziente = generate_patient_code(nome or "X", cognome)
+                used_codes.add(codice_paziente)
                 
                 # Determina tipo paziente basato sugli appuntamenti
-                patient_tipos = set()
-                for apt in all_appointments:
-                    if apt["cognome"] == cognome and apt["nome"] == nome:
-                        patient_tipos.add(apt["tipo"])
+                patient_tipos = tipos_by_name[(cognome, nome)]
                 
                 if "PICC" in patient_tipos and "MED" in patient_tipos:
                     patient_tipo = "PICC_MED"
@@ -5149,17 +5676,49 @@ async def sync_from_google_sheets(
                     "codice_paziente": codice_paziente,
                     "nome": nome or "",
                     "cognome": cognome,
+                    **patient_name_keys(cognome, nome),
                     "tipo": patient_tipo,
                     "ambulatorio": data.ambulatorio.value,
                     "status": "in_cura",
                     "scheda_med_counter": 0,
                     "lesion_markers": [],
-                    "created_at": datetime.now(timezone.utc).isoformat(),
-                    "updated_at": datetime.now(timezone.utc).isoformat()
+                    "created_at": now_iso,
+                    "updated_at": now_iso
                 }
-                await db.patients.insert_one(new_patient)
+                new_patients.append(new_patient)
                 patient_id_map[(cognome, nome)] = new_patient_id
-                created_patients += 1
+        
+        failed_patients = await insert_many_unordered(db.patients, new_patients)
+        for i in failed_patients:
+            patient_id_map.pop((new_patients[i]["cognome"], new_patients[i]["nome"]), None)
+        created_patients = len(new_patients) - len(failed_patients)
+        
+        # Carica una sola volta gli appuntamenti già presenti nelle date del foglio
+        existing_apts = await db.appointments.find(
+            {
+                "ambulatorio": data.ambulatorio.value,
+                "data": {"$in": sorted({apt["date"] for apt in all_appointments})}
+            },
+            {"_id": 0, "id": 1, "patient_id": 1, "data": 1, "ora": 1, "tipo": 1, "note": 1, "seq": 1}
+        ).to_list(None)
+        
+        existing_slots = {}  # {(patient_id, data, ora): id se manuale, altrimenti None}
+        type_counts = Counter()  # {(data, ora, tipo): n}
+        manual_counts = Counter()  # {(data, ora): n}
+        total_counts = Counter()  # {(data, ora): n}
+        slot_seqs = defaultdict(set)  # {(data, ora, tipo): posti (seq) occupati}
+        for e in existing_apts:
+            is_manual = e.get("note") != "Importato da Google Sheets"
+            existing_slots.setdefault((e.get("patient_id"), e["data"], e.get("ora")), e["id"] if is_manual else None)
+            type_counts[(e["data"], e.get("ora"), e.get("tipo"))] += 1
+            if "seq" in e:
+                slot_seqs[(e["data"], e.get("ora"), e.get("tipo"))].add(e["seq"])
+            total_counts[(e["data"], e.get("ora"))] += 1
+            if is_manual:
+                manual_counts[(e["data"], e.get("ora"))] += 1
+        
+        new_apts = []
+        not_presented_ids = set()
         
         # Crea appuntamenti
         for apt in all_appointments:
@@ -5167,57 +5726,34 @@ async def sync_from_google_sheets(
             if not patient_id:
                 continue
             
-            # Verifica se esiste già un appuntamento per questo paziente in questo slot
-            existing_apt = await db.appointments.find_one({
-                "patient_id": patient_id,
-                "data": apt["date"],
-                "ora": apt["ora"],
-                "ambulatorio": data.ambulatorio.value
-            })
+            slot = (apt["date"], apt["ora"])
             
-            if existing_apt:
+            # Verifica se esiste già un appuntamento per questo paziente in questo slot
+            patient_slot = (patient_id, apt["date"], apt["ora"])
+            if patient_slot in existing_slots:
                 # Se l'appuntamento esistente è manuale (non da Google Sheets), aggiorna solo lo stato
-                if existing_apt.get("note") != "Importato da Google Sheets":
-                    # Aggiorna solo se l'appuntamento dal foglio indica "non presentato"
-                    if apt.get("not_presented"):
-                        await db.appointments.update_one(
-                            {"id": existing_apt["id"]},
-                            {"$set": {"stato": "non_presentato"}}
-                        )
+                manual_id = existing_slots[patient_slot]
+                # Aggiorna solo se l'appuntamento dal foglio indica "non presentato"
+                if manual_id and apt.get("not_presented"):
+                    not_presented_ids.add(manual_id)
                 skipped_appointments += 1
                 continue
             
             # Controlla il numero di slot per tipo in questo orario
-            # Normalmente max 3 PICC + 2 MED, ma se ci sono appuntamenti manuali, max 5 totali
-            slot_count_same_type = await db.appointments.count_documents({
-                "ambulatorio": data.ambulatorio.value,
-                "data": apt["date"],
-                "ora": apt["ora"],
-                "tipo": apt["tipo"]
-            })
-            
-            # Conta appuntamenti manuali in questo slot
-            manual_count = await db.appointments.count_documents({
-                "ambulatorio": data.ambulatorio.value,
-                "data": apt["date"],
-                "ora": apt["ora"],
-                "note": {"$ne": "Importato da Google Sheets"}
-            })
-            
-            # Limiti normali: PICC=3, MED=2
-            max_slots = 3 if apt["tipo"] == "PICC" else 2
-            
-            # Se ci sono appuntamenti manuali, permetti fino a 5 totali
-            if manual_count > 0:
-                total_count = await db.appointments.count_documents({
-                    "ambulatorio": data.ambulatorio.value,
-                    "data": apt["date"],
-                    "ora": apt["ora"]
-                })
-                if total_count >= 5:
-                    skipped_appointments += 1
-                    continue
-            elif slot_count_same_type >= max_slots:
+            # Normalmente max 3 PICC + 2 MED, ma se ci sono appuntamenti manuali, max 5 totali.
+            # Se il paziente compare sia in PICC che in MED usa la prima colonna con posto libero
+            tipo = None
+            for candidate in apt["tipi"]:
+                if manual_counts[slot] > 0:
+                    # Se ci sono appuntamenti manuali, permetti fino a 5 totali
+                    has_room = total_counts[slot] < 5
+                else:
+                    # Limiti normali: PICC=3, MED=2
+                    has_room = type_counts[(*slot, candidate)] < (3 if candidate == "PICC" else 2)
+                if has_room:
+                    tipo = candidate
+                    break
+            if tipo is None:
                 skipped_appointments += 1
                 continue
             
@@ -5233,15 +5769,29 @@ async def sync_from_google_sheets(
                 "ambulatorio": data.ambulatorio.value,
                 "data": apt["date"],
                 "ora": apt["ora"],
-                "tipo": apt["tipo"],
-                "prestazioni": ["medicazione_semplice"] if apt["tipo"] == "MED" else ["medicazione_semplice", "irrigazione_catetere"],
+                "tipo": tipo,
+                "prestazioni": ["medicazione_semplice"] if tipo == "MED" else ["medicazione_semplice", "irrigazione_catetere"],
                 "note": "Importato da Google Sheets",
                 "stato": stato,
                 "completed": False,
-                "created_at": datetime.now(timezone.utc).isoformat()
+                "created_at": now_iso
             }
-            await db.appointments.insert_one(new_apt)
-            created_appointments += 1
+            # Il foglio ha limiti propri (3 PICC, 5 con manuali): il seq può superare SLOT_CAPACITY,
+            # ma l'appuntamento occupa comunque un posto e conta per le prenotazioni successive
+            seqs = slot_seqs[(*slot, tipo)]
+            new_apt["seq"] = first_free_seq(seqs)
+            seqs.add(new_apt["seq"])
+            new_apts.append(new_apt)
+            existing_slots[patient_slot] = None
+            type_counts[(*slot, tipo)] += 1
+            total_counts[slot] += 1
+        
+        if not_presented_ids:
+            await db.appointments.update_many(
+                {"id": {"$in": list(not_presented_ids)}},
+                {"$set": {"stato": "non_presentato"}}
+            )
+        created_appointments = len(new_apts) - len(await insert_many_unordered(db.appointments, new_apts))
         
         return {
             "success": True,
@@ -5258,6 +5808,9 @@ async def sync_from_google_sheets(
     except Exception as e:
         logger.error(f"Google Sheets sync error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Errore nella sincronizzazione: {str(e)}")
+    finally:
+        # Anche in caso di errore: la pulizia di clear_existing potrebbe essere già avvenuta
+        invalidate_period_stats()
 
 @api_router.post("/sync/google-sheets/analyze")
 async def analyze_google_sheets_sync(
@@ -5272,35 +5825,18 @@ async def analyze_google_sheets_sync(
     year = data.year
     
     try:
-        # Scarica il foglio come XLSX
-        xlsx_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=xlsx"
-        
-        async with httpx.AsyncClient(follow_redirects=True) as http_client:
-            response = await http_client.get(xlsx_url, timeout=60.0)
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail="Impossibile accedere al foglio Google")
-        
-        # Carica workbook per dati e colori
-        wb_data = load_workbook(io.BytesIO(response.content), data_only=True)
-        wb_colors = load_workbook(io.BytesIO(response.content), data_only=False)
+        # Scarica il foglio come XLSX (l'analisi non usa i colori)
+        sheets = await load_sheet_data(sheet_id, year, read_colors=False)
         
         # Parse tutti i fogli
         all_appointments = []
         all_patients = set()
         sheets_processed = []
         
-        for sheet_name in wb_data.sheetnames:
-            ws_data = wb_data[sheet_name]
-            ws_colors = wb_colors[sheet_name] if sheet_name in wb_colors.sheetnames else None
-            
-            if ws_data.max_row < 7 or ws_data.max_column < 5:
-                continue
-            
-            appointments, patients = parse_sheet_data(ws_data, year, ws_colors)
-            if appointments:
-                all_appointments.extend(appointments)
-                all_patients.update(patients)
-                sheets_processed.append(sheet_name)
+        for sheet_name, appointments, patients in sheets:
+            all_appointments.extend(appointments)
+            all_patients.update(patients)
+            sheets_processed.append(sheet_name)
         
         # Ottieni nomi esistenti dal database
         existing_patients = await db.patients.find(
@@ -5324,7 +5860,7 @@ async def analyze_google_sheets_sync(
                 name_occurrences[full_name] = {"count": 0, "dates": set(), "tipo": set()}
             name_occurrences[full_name]["count"] += 1
             name_occurrences[full_name]["dates"].add(apt["date"])
-            name_occurrences[full_name]["tipo"].add(apt["tipo"])
+            name_occurrences[full_name]["tipo"].update(apt["tipi"])
         
         # Trova potenziali errori di battitura
         conflicts = []
@@ -5417,6 +5953,83 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    """Crea gli indici usati dalle query più frequenti (idempotente)"""
+    await db.ai_chat_history.create_index([("session_id", 1), ("timestamp", -1)])
+    await db.ai_chat_history.create_index([("user_id", 1), ("ambulatorio", 1), ("timestamp", -1)])
+    await db.ai_chat_history.create_index([("user_id", 1), ("ambulatorio", 1), ("session_id", 1), ("timestamp", -1)])
+    await db.appointments.create_index([("ambulatorio", 1), ("data", 1), ("tipo", 1), ("ora", 1)])
+    await db.appointments.create_index([("ambulatorio", 1), ("patient_id", 1), ("data", 1)])
+    await db.appointments.create_index([("ambulatorio", 1), ("data", 1), ("stato", 1)])
+    await db.appointments.create_index("patient_id")
+    await db.appointments.create_index(
+        [("ambulatorio", 1), ("data", 1), ("tipo", 1), ("ora", 1), ("seq", 1)],
+        unique=True, partialFilterExpression={"seq": {"$exists": True}}
+    )
+    try:
+        await db.patients.create_index("id", unique=True)
+    except OperationFailure as e:
+        logger.warning(f"Indice unico patients.id non creato (id duplicati?): {e}")
+    try:
+        # Parziale: i pazienti creati senza codice (AI, legacy) lo ricevono solo alla prima scheda
+        await db.patients.create_index(
+            "codice_paziente", unique=True,
+            partialFilterExpression={"codice_paziente": {"$gt": ""}}
+        )
+    except OperationFailure as e:
+        logger.warning(f"Indice unico patients.codice_paziente non creato (codici duplicati?): {e}")
+    await db.patients.create_index([("ambulatorio", 1), ("cognome", 1), ("nome", 1)])
+    await db.patients.create_index([("ambulatorio", 1), ("cognome_lc", 1), ("nome_lc", 1)])
+    await db.patients.create_index([("nome", "text"), ("cognome", "text")], default_language="italian")
+    await db.schede_impianto_picc.create_index([("ambulatorio", 1), ("data_impianto", 1), ("tipo_catetere", 1)])
+    await db.schede_impianto_picc.create_index("patient_id")
+    await db.schede_medicazione_med.create_index([("patient_id", 1), ("ambulatorio", 1), ("created_at", -1)])
+    await db.schede_gestione_picc.create_index([("patient_id", 1), ("ambulatorio", 1), ("created_at", -1)])
+    await db.prescrizioni.create_index("patient_id")
+    await db.ai_undo_history.create_index([("user_id", 1), ("ambulatorio", 1), ("timestamp", -1)])
+    await db.ai_undo_history.create_index("expire_at", expireAfterSeconds=0)
+    
+    # Assegna un posto (seq) agli appuntamenti che non lo hanno (precedenti all'indice sugli slot)
+    missing_seq = await db.appointments.find(
+        {"seq": {"$exists": False}}, {"ambulatorio": 1, "data": 1, "tipo": 1, "ora": 1}
+    ).to_list(None)
+    if missing_seq:
+        def slot_key(a):
+            return a.get("ambulatorio"), a.get("data"), a.get("tipo"), a.get("ora")
+        used_seqs = defaultdict(set)
+        async for a in db.appointments.find(
+            {"seq": {"$exists": True}, "data": {"$in": list({a.get("data") for a in missing_seq})}},
+            {"ambulatorio": 1, "data": 1, "tipo": 1, "ora": 1, "seq": 1}
+        ):
+            used_seqs[slot_key(a)].add(a["seq"])
+        updates = []
+        for a in missing_seq:
+            seqs = used_seqs[slot_key(a)]
+            seq = first_free_seq(seqs)
+            seqs.add(seq)
+            updates.append(UpdateOne({"_id": a["_id"], "seq": {"$exists": False}}, {"$set": {"seq": seq}}))
+        try:
+            await db.appointments.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            logger.warning(f"Backfill seq appuntamenti incompleto: {e.details.get('writeErrors', [])[:3]}")
+        logger.info(f"Backfill seq su {len(missing_seq)} appuntamenti")
+    
+    # Le prescrizioni più vecchie non hanno "id": usa l'ObjectId come stringa
+    await db.prescrizioni.update_many({"id": {"$exists": False}}, [{"$set": {"id": {"$toString": "$_id"}}}])
+    
+    # Backfill dei campi normalizzati per i pazienti creati prima della loro introduzione
+    missing = await db.patients.find({"cognome_lc": {"$exists": False}}, {"cognome": 1, "nome": 1}).to_list(None)
+    if missing:
+        await db.patients.bulk_write([
+            UpdateOne({"_id": p["_id"]}, {"$set": patient_name_keys(p.get("cognome"), p.get("nome"))})
+            for p in missing
+        ])
+        logger.info(f"Backfill cognome_lc/nome_lc su {len(missing)} pazienti")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+    if _openai_client is not None:
+        await _openai_client.close()
+    await _sheets_http_client.aclose()
@@ -493,7 +493,7 @@ export default function AIAssistant() {
         // Se l'utente usa pronomi o riferimenti, aggiungi contesto
         const pronouns = ["lui", "lei", "questo", "questa", "stesso", "stessa", "paziente"];
         if (pronouns.some(p => lowerMsg.includes(p))) {
-          messageWithContext = `[Contesto: ultimo paziente discusso = ${contextMemory.lastPatient.cognome} ${contextMemory.lastPatient.nome}] ${userMessage}`;
+          messageWithContext = `[Contesto: ultimo paziente discusso = ${contextMemory.lastPatient.cognome} ${contextMemory.lastPatient.nome} (id: ${contextMemory.lastPatient.id})] ${userMessage}`;
         }
       }
       